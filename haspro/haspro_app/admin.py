@@ -10,7 +10,11 @@ from .models import (
     FiredistinguisherServiceAction,
     InspectionRecord,
     FaultInspection,
-    FaultPhoto
+    FaultPhoto,
+    DeletedRecord,
+    BackgroundJob,
+    UploadSession,
+    UploadReceipt
 )
 
 
@@ -25,7 +29,11 @@ REGISTERED_MODELS = [
     FiredistinguisherServiceAction,
     InspectionRecord,
     FaultInspection,
-    FaultPhoto
+    FaultPhoto,
+    DeletedRecord,
+    BackgroundJob,
+    UploadSession,
+    UploadReceipt
 ]
 
 SKIP_FIELDS = {
@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from haspro_app.utils.media_gc import delete_media_files, find_orphaned_media, mark_referenced_media, open_mark_db
+
+
+class Command(BaseCommand):
+    help = "Find files in MEDIA_ROOT no database row references and delete them (mark and sweep)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only list the orphaned files, do not delete them.")
+        parser.add_argument('--min-age', type=float, default=24, help="Keep files modified less than this many hours ago.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Orphaned files deleted and reported at once.")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            marked = open_mark_db(os.path.join(tmp_dir, 'marked.sqlite3'))
+            try:
+                num_rows = mark_referenced_media(marked)
+                self.stdout.write(f"Marked files of {num_rows} database rows.")
+
+                num_orphaned = 0
+                num_deleted = 0
+                total_size = 0
+                batch = []
+                for name, size in find_orphaned_media(marked, min_age=options['min_age'] * 3600):
+                    num_orphaned += 1
+                    total_size += size
+                    if options['dry_run'] or options['verbosity'] > 1:
+                        self.stdout.write(name)
+                    batch.append(name)
+                    if len(batch) >= options['batch_size']:
+                        num_deleted += self._sweep(batch, options['dry_run'])
+                        batch = []
+                num_deleted += self._sweep(batch, options['dry_run'])
+            finally:
+                marked.close()
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Found {num_orphaned} orphaned files ({total_size} bytes), nothing deleted."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Deleted {num_deleted} orphaned files ({total_size} bytes)."))
+
+    def _sweep(self, batch, dry_run):
+        if dry_run or not batch:
+            return 0
+        num_deleted = delete_media_files(batch)
+        self.stdout.write(f"Deleted {num_deleted} files.")
+        return num_deleted
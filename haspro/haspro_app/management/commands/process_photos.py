@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from haspro_app.models import Company, FaultPhoto
+from haspro_app.utils.photos import make_renditions_task
+
+
+class Command(BaseCommand):
+    help = "Create missing thumbnails and web renditions of fault photos using all CPU cores."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, help="Limit the processing to photos of the company with this ID.")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes, all cores by default.")
+        parser.add_argument('--batch-size', type=int, default=500, help="Photos handed to the workers and marked as processed at once.")
+        parser.add_argument('--force', action='store_true', help="Recreate the renditions of all photos, also those already processed.")
+
+    def handle(self, *args, **options):
+        photos = FaultPhoto.objects.all()
+        if options['company'] is not None:
+            company = Company.objects.filter(pk=options['company']).first()
+            if not company:
+                raise CommandError(f"Company with ID {options['company']} does not exist.")
+            photos = photos.filter(fault_inspection__inspection__building__company=company)
+        if not options['force']:
+            photos = photos.filter(renditions_ready=False)
+
+        storage = FaultPhoto._meta.get_field('photo').storage
+        num_processed = 0
+        num_failed = 0
+        last_id = 0
+        # Workers only decode and encode images, spawned fresh they hold no database connections
+        with ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context('spawn')) as executor:
+            while True:
+                # Paged by ID, the rows are updated while going through them
+                batch = list(photos.filter(id__gt=last_id).order_by('id').values_list('id', 'photo')[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+
+                paths = [storage.path(name) for _, name in batch]
+                errors = executor.map(make_renditions_task, paths, [options['force']] * len(paths), chunksize=8)
+
+                processed = []
+                for (photo_id, _), error in zip(batch, errors):
+                    if error:
+                        self.stderr.write(error)
+                        num_failed += 1
+                    else:
+                        processed.append(photo_id)
+                FaultPhoto.objects.filter(id__in=processed).update(renditions_ready=True)
+                num_processed += len(processed)
+                self.stdout.write(f"Processed {num_processed} photos.")
+
+        self.stdout.write(self.style.SUCCESS(f"Processed {num_processed} photos, {num_failed} could not be read."))
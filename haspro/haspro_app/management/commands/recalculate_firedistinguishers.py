@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from haspro_app.models import Company, Firedistinguisher
+from haspro_app.utils.recalculation import recalculate_firedistinguishers
+
+
+class Command(BaseCommand):
+    help = "Recompute next inspection, next periodic test and elimination of fire extinguishers from their service action history."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, help="Limit the recalculation to extinguishers managed by the company with this ID.")
+
+    def handle(self, *args, **options):
+        firedistinguishers = None
+        if options['company'] is not None:
+            company = Company.objects.filter(pk=options['company']).first()
+            if not company:
+                raise CommandError(f"Company with ID {options['company']} does not exist.")
+            firedistinguishers = Firedistinguisher.objects.filter(managed_by=company).values('pk')
+
+        with transaction.atomic():
+            num_updated = recalculate_firedistinguishers(firedistinguishers)
+
+        self.stdout.write(self.style.SUCCESS(f"Updated {num_updated} fire extinguishers."))
@@ -0,0 +1,44 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from haspro_app.models import BackgroundJobKind
+from haspro_app.utils.jobs import claim_next_job, requeue_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = "Process queued background jobs. Any number of workers can run at once."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty instead of waiting for new jobs.")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait before checking an empty queue again.")
+        parser.add_argument('--kind', action='append', choices=BackgroundJobKind.values, help="Process only jobs of this kind, can be repeated.")
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        # Finish the running job before exiting on shutdown
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        while not self.stopping:
+            close_old_connections()
+
+            num_requeued = requeue_stale_jobs()
+            if num_requeued:
+                self.stdout.write(self.style.WARNING(f"Queued {num_requeued} abandoned jobs again."))
+
+            job = claim_next_job(options['kind'])
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write(f"Running {job}")
+            run_job(job)
+            self.stdout.write(f"Finished {job}")
+
+    def _stop(self, signum, frame):
+        self.stopping = True
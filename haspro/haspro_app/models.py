@@ -1,8 +1,14 @@
-from django.db import models
+import itertools
+import threading
+
+from django.db import models, transaction
+from django.db.models.signals import post_delete, pre_delete
 from django.utils.translation import gettext_lazy as _
 
 from users.models import Project, User
 
+from .storage import content_storage
+
 import math
 
 
@@ -15,6 +21,7 @@ class Company(models.Model):
 	ico = models.CharField(_("IČO"), max_length=20)
 	dic = models.CharField(_("DIČ"), max_length=20)
 	logo = models.FileField(_("Logo"), upload_to='company_logos/', blank=True, null=True)
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 
 	class Meta:
 		verbose_name = _("Company")
@@ -31,6 +38,7 @@ class BuildingOwner(models.Model):
 	ico = models.CharField(_("IČO"), max_length=20)
 	dic = models.CharField(_("DIČ"), max_length=20)
 	managed_by = models.ForeignKey(Company, on_delete=models.SET_NULL, null=True, blank=True, verbose_name=_("Managed by"))
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 
 	class Meta:
 		verbose_name = _("Building Owner")
@@ -45,6 +53,7 @@ class BuildingManager(models.Model):
 	phone = models.CharField(_("Phone"), max_length=30)
 	phone2 = models.CharField(_("Phone 2"), max_length=30, blank=True, null=True)
 	email = models.EmailField(_("Email"))
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 
 	class Meta:
 		verbose_name = _("Building Manager")
@@ -64,6 +73,7 @@ class Building(models.Model):
 	manager = models.ForeignKey(BuildingManager, on_delete=models.SET_NULL, null=True, blank=True, verbose_name=_("Manager"))
 	last_inspection_date = models.DateField(_("Last Inspection Date"), null=True, blank=True)
 	inspection_interval_days = models.IntegerField(_("Inspection Interval (Days)"), default=180)
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 
 	class Meta:
 		verbose_name = _("Building")
@@ -79,6 +89,7 @@ class Fault(models.Model):
 	short_name = models.CharField(_("Short Name"), max_length=100)
 	description = models.TextField(_("Description"))
 	default_fix_time_days = models.IntegerField(_("Default Fix Time (Days)"))
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 
 	class Meta:
 		verbose_name = _("Fault")
@@ -90,6 +101,7 @@ class Fault(models.Model):
 class PossibleFault(models.Model):
 	fault = models.ForeignKey(Fault, on_delete=models.CASCADE, verbose_name=_("Fault"))
 	building = models.ForeignKey(Building, on_delete=models.CASCADE, verbose_name=_("Building"))
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 
 	class Meta:
 		verbose_name = _("Possible Fault")
@@ -118,6 +130,7 @@ class Firedistinguisher(models.Model):
 	managed_by = models.ForeignKey(Company, on_delete=models.SET_NULL, null=True, blank=True, verbose_name=_("Managed by"))
 	next_inspection = models.DateField(_("Next Inspection"), null=True, blank=True)
 	next_periodic_test = models.DateField(_("Next Periodic Test"), null=True, blank=True)
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 
 	class Meta:
 		verbose_name = _("Fire Extinguisher")
@@ -141,6 +154,7 @@ class FiredistinguisherPlacement(models.Model):
 	created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
 	firedistinguisher = models.ForeignKey(Firedistinguisher, on_delete=models.CASCADE, verbose_name=_("Fire Extinguisher"))
 	building = models.ForeignKey(Building, on_delete=models.CASCADE, verbose_name=_("Building"))
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 
 	class Meta:
 		verbose_name = _("Fire Extinguisher Placement")
@@ -169,6 +183,7 @@ class FiredistinguisherServiceAction(models.Model):
 	description = models.CharField(_("Description"), max_length=255)
 	created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
 	inspection = models.ForeignKey('InspectionRecord', on_delete=models.SET_NULL, null=True, blank=True, verbose_name=_("Inspection"), related_name='firedistinguisher_actions')
+	updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
 	
 	class Meta:
 		verbose_name = _("Fire Extinguisher Service Action")
@@ -185,14 +200,34 @@ class InspectionRecord(models.Model):
     notes = models.TextField(_("Notes"), blank=True, null=True)
     building = models.ForeignKey(Building, on_delete=models.CASCADE, verbose_name=_("Building"))
     created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
-    uploaded_file = models.FileField(_("Uploaded File"), upload_to='inspection_uploads/', blank=True, null=True)
+    uploaded_file = models.FileField(_("Uploaded File"), upload_to='inspection_uploads/', storage=content_storage, db_index=True, blank=True, null=True)
+    upload_sha256 = models.CharField(_("Upload SHA-256"), max_length=64, db_index=True, blank=True, null=True)
+    upload_record_id = models.IntegerField(_("Upload Record ID"), blank=True, null=True)
 
     class Meta:
         verbose_name = _("Inspection Record")
         verbose_name_plural = _("Inspection Records")
+        constraints = [
+            # Each inspection record of an uploaded database is imported once
+            models.UniqueConstraint(fields=['upload_sha256', 'upload_record_id'], name='unique_uploaded_inspection_record'),
+        ]
 
     def __str__(self):
         return f"Inspection on {self.date} by {self.inspector}"
+
+
+class UploadReceipt(models.Model):
+    """An uploaded inspection database all of whose records were imported, with the results of that import."""
+    upload_sha256 = models.CharField(_("Upload SHA-256"), max_length=64, unique=True)
+    results = models.JSONField(_("Results"))
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Upload Receipt")
+        verbose_name_plural = _("Upload Receipts")
+
+    def __str__(self):
+        return f"Upload {self.upload_sha256} imported at {self.created_at}"
 	
 
 class FaultInspection(models.Model):
@@ -215,8 +250,9 @@ class FaultInspection(models.Model):
 
 class FaultPhoto(models.Model):
     fault_inspection = models.ForeignKey(FaultInspection, on_delete=models.CASCADE, verbose_name=_("Fault Inspection"))
-    photo = models.ImageField(_("Photo"), upload_to='fault_photos/')
+    photo = models.ImageField(_("Photo"), upload_to='fault_photos/', storage=content_storage, db_index=True)
     uploaded_at = models.DateTimeField(_("Uploaded at"), auto_now_add=True)
+    renditions_ready = models.BooleanField(_("Renditions ready"), default=False, db_index=True)
 
     class Meta:
         verbose_name = _("Fault Photo")
@@ -225,3 +261,185 @@ class FaultPhoto(models.Model):
     def __str__(self):
         return f"Photo {self.id} uploaded at {self.uploaded_at}"
 
+
+class UploadSession(models.Model):
+    """Resumable upload of an inspection database, received in chunks into a spool file."""
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name=_("Company"))
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, verbose_name=_("Created by"))
+    file_name = models.CharField(_("File Name"), max_length=255)
+    size = models.BigIntegerField(_("Size"))
+    received = models.BigIntegerField(_("Received"), default=0)
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
+    updated_at = models.DateTimeField(_("Updated at"), auto_now=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("Upload Session")
+        verbose_name_plural = _("Upload Sessions")
+
+    def __str__(self):
+        return f"{self.file_name} ({self.received}/{self.size})"
+
+
+class BackgroundJobKind(models.TextChoices):
+    INSPECTION_UPLOAD = 'inspection_upload', _('Inspection Upload')
+    INSPECTION_BATCH_UPLOAD = 'inspection_batch_upload', _('Inspection Batch Upload')
+    PHOTO_PROCESSING = 'photo_processing', _('Photo Processing')
+    BUILDING_MANAGER_IMPORT = 'building_manager_import', _('Building Manager Import')
+    FIREDISTINGUISHER_IMPORT = 'firedistinguisher_import', _('Fire Extinguisher Import')
+    BUILDING_MANAGER_PREVIEW = 'building_manager_preview', _('Building Manager Import Preview')
+    FIREDISTINGUISHER_PREVIEW = 'firedistinguisher_preview', _('Fire Extinguisher Import Preview')
+
+
+class BackgroundJobStatus(models.TextChoices):
+    QUEUED = 'queued', _('Queued')
+    RUNNING = 'running', _('Running')
+    SUCCEEDED = 'succeeded', _('Succeeded')
+    FAILED = 'failed', _('Failed')
+
+
+class BackgroundJob(models.Model):
+    """Work accepted by a request and processed later by the `run_jobs` worker."""
+    kind = models.CharField(_("Kind"), max_length=50, choices=BackgroundJobKind.choices)
+    status = models.CharField(_("Status"), max_length=20, choices=BackgroundJobStatus.choices, default=BackgroundJobStatus.QUEUED, db_index=True)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name=_("Company"))
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, verbose_name=_("Created by"))
+    input_file = models.FileField(_("Input File"), upload_to='job_inputs/', blank=True, null=True)
+    parameters = models.JSONField(_("Parameters"), default=dict, blank=True)
+    progress = models.PositiveSmallIntegerField(_("Progress"), default=0)
+    result = models.JSONField(_("Result"), blank=True, null=True)
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
+    started_at = models.DateTimeField(_("Started at"), blank=True, null=True)
+    heartbeat_at = models.DateTimeField(_("Heartbeat at"), blank=True, null=True)
+    finished_at = models.DateTimeField(_("Finished at"), blank=True, null=True)
+
+    class Meta:
+        verbose_name = _("Background Job")
+        verbose_name_plural = _("Background Jobs")
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.id} ({self.get_status_display()})"
+
+
+class DeletedRecord(models.Model):
+    """Tombstone of a row removed from one of the tables synced to the mobile app."""
+    table_name = models.CharField(_("Table Name"), max_length=100)
+    record_id = models.BigIntegerField(_("Record ID"))
+    # Not a foreign key, tombstones of a company's rows are written while the company itself is deleted.
+    # Empty for rows shared by all companies (managers, faults).
+    company_id = models.BigIntegerField(_("Company ID"), blank=True, null=True, db_index=True)
+    deleted_at = models.DateTimeField(_("Deleted at"), auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("Deleted Record")
+        verbose_name_plural = _("Deleted Records")
+
+    def __str__(self):
+        return f"{self.table_name} {self.record_id} deleted at {self.deleted_at}"
+
+
+# Models exported to the mobile app and the table names they use in the snapshot file
+SYNCED_MODEL_TABLES = {
+    Company: "company",
+    BuildingOwner: "building_owner",
+    BuildingManager: "building_manager",
+    Building: "building",
+    Fault: "fault",
+    PossibleFault: "possible_fault",
+    Firedistinguisher: "firedistinguisher",
+    FiredistinguisherPlacement: "firedistinguisher_placement",
+    FiredistinguisherServiceAction: "firedistinguisher_service_action",
+}
+
+
+# The company whose clients receive the tombstone of a deleted row, missing for shared tables
+DELETED_RECORD_COMPANY = {
+    Company: lambda instance: instance.pk,
+    BuildingOwner: lambda instance: instance.managed_by_id,
+    Building: lambda instance: instance.company_id,
+    Firedistinguisher: lambda instance: instance.managed_by_id,
+}
+# Rows taking the company of their extinguisher, or else of their building, as (firedistinguisher ID, building ID).
+# The extinguisher is unlinked from a deleted company before its placements are deleted with the buildings.
+DELETED_RECORD_PARENTS = {
+    PossibleFault: lambda instance: (None, instance.building_id),
+    FiredistinguisherPlacement: lambda instance: (instance.firedistinguisher_id, instance.building_id),
+    FiredistinguisherServiceAction: lambda instance: (instance.firedistinguisher_id, None),
+}
+
+# Parent IDs looked up per query when the tombstones are written
+DELETED_RECORD_LOOKUP_SIZE = 500
+
+
+class _DeletionBatch:
+    """
+    Tombstones of one delete, written at once when its transaction commits. Deleting a building or company
+    cascades over thousands of rows, a lookup and an INSERT for each would multiply the queries of the delete.
+    """
+    def __init__(self, using, origin):
+        self.using = using
+        self.origin = origin
+        self.sending_pre_delete = True
+        # (table name, record ID, company ID, firedistinguisher ID, building ID)
+        self.records = []
+        # Companies of the deleted extinguishers and buildings, before a deleted company unlinks them
+        self.parent_companies = {Firedistinguisher: {}, Building: {}}
+
+    def _look_up_companies(self, model, field, ids):
+        companies = self.parent_companies[model]
+        missing = sorted({pk for pk in ids if pk is not None} - companies.keys())
+        for batch in itertools.batched(missing, DELETED_RECORD_LOOKUP_SIZE):
+            companies.update(model.objects.using(self.using).filter(pk__in=batch).values_list('pk', field))
+
+    def write(self):
+        if getattr(_deletion_batches, self.using, None) is self:
+            delattr(_deletion_batches, self.using)
+
+        self._look_up_companies(Firedistinguisher, 'managed_by_id', (record[3] for record in self.records if record[2] is None))
+        self._look_up_companies(Building, 'company_id', (record[4] for record in self.records if record[2] is None))
+        firedistinguisher_companies = self.parent_companies[Firedistinguisher]
+        building_companies = self.parent_companies[Building]
+        DeletedRecord.objects.using(self.using).bulk_create([
+            DeletedRecord(
+                table_name=table_name,
+                record_id=record_id,
+                company_id=company_id or firedistinguisher_companies.get(firedistinguisher_id) or building_companies.get(building_id),
+            )
+            for table_name, record_id, company_id, firedistinguisher_id, building_id in self.records
+        ], batch_size=DELETED_RECORD_LOOKUP_SIZE)
+
+
+# The batch of the delete running in this thread, per database
+_deletion_batches = threading.local()
+
+
+def _deletion_batch(using, origin, starting):
+    """
+    A delete sends pre_delete for all of its rows before the first post_delete,
+    a pre_delete after post_delete signals (or of another origin) starts the next delete.
+    """
+    batch = getattr(_deletion_batches, using, None)
+    if batch is None or (starting and (not batch.sending_pre_delete or batch.origin is not origin)):
+        batch = _DeletionBatch(using, origin)
+        setattr(_deletion_batches, using, batch)
+        # Dropped with the deleted rows when the transaction rolls back
+        transaction.on_commit(batch.write, using=using)
+    return batch
+
+
+def _collect_deletion(sender, instance, using, origin=None, **kwargs):
+    batch = _deletion_batch(using, origin, starting=True)
+    if sender in batch.parent_companies:
+        batch.parent_companies[sender][instance.pk] = DELETED_RECORD_COMPANY[sender](instance)
+
+
+def _record_deletion(sender, instance, using, origin=None, **kwargs):
+    batch = _deletion_batch(using, origin, starting=False)
+    batch.sending_pre_delete = False
+    company_id = DELETED_RECORD_COMPANY[sender](instance) if sender in DELETED_RECORD_COMPANY else None
+    firedistinguisher_id, building_id = DELETED_RECORD_PARENTS[sender](instance) if sender in DELETED_RECORD_PARENTS else (None, None)
+    batch.records.append((SYNCED_MODEL_TABLES[sender], instance.pk, company_id, firedistinguisher_id, building_id))
+
+
+for synced_model in SYNCED_MODEL_TABLES:
+    pre_delete.connect(_collect_deletion, sender=synced_model, dispatch_uid=f"collect_deletion_{synced_model.__name__}")
+    post_delete.connect(_record_deletion, sender=synced_model, dispatch_uid=f"record_deletion_{synced_model.__name__}")
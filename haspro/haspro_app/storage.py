@@ -0,0 +1,65 @@
+import hashlib
+import os
+import uuid
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+def content_sha256(content):
+    """
+    SHA-256 of a file, computed by the upload handler while the file was received,
+    or read in chunks for files from elsewhere.
+    """
+    if getattr(content, "sha256", None):
+        return content.sha256
+
+    sha256 = hashlib.sha256()
+    for chunk in content.chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Media storage naming files by the SHA-256 of their content, so identical bytes are stored once:
+    `<upload_to>/<first two hex digits>/<sha256>.<extension>`.
+    Files may be shared by many rows and are never deleted through the storage, a row referencing a file
+    becomes visible only when its transaction commits, so no check before deleting is safe against an import
+    storing the same content at once. The `collect_orphaned_media` command removes files nothing references
+    after they have not been touched for a while.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        content_hash = content_sha256(content)
+        directory, file_name = os.path.split(name)
+        extension = os.path.splitext(file_name)[1].lower()
+        name = os.path.join(directory, content_hash[:2], f"{content_hash}{extension}")
+        return super().save(name, content, max_length=max_length)
+
+    def get_available_name(self, name, max_length=None):
+        # An existing file of the same name has the same content
+        if max_length and len(name) > max_length:
+            raise SuspiciousFileOperation(f"Storage can not find an available filename for \"{name}\".")
+        return name
+
+    def _save(self, name, content):
+        if self.exists(name):
+            # Stored again, e.g. by a retried import, the age check of the orphan collection starts over
+            os.utime(self.path(name))
+            return name
+        # Written aside and renamed, an existing name always holds the complete content
+        tmp_name = super()._save(f"{name}.{uuid.uuid4().hex}.tmp", content)
+        os.replace(self.path(tmp_name), self.path(name))
+        return name
+
+    def delete(self, name):
+        pass
+
+
+# Shared by the fields of uploaded inspection data
+content_storage = ContentAddressedStorage()
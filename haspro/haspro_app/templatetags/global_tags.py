@@ -1,5 +1,6 @@
 from django import template
 from django.conf import settings
+from django.urls import reverse
 
 _ = None  # Dummy variable to ensure the import is not optimized away
 
@@ -10,3 +11,9 @@ register = template.Library()
 def get_analytics_id():
     """Get Google Analytics ID from settings."""
     return settings.GOOGLE_ANALYTICS_ID
+
+
+@register.simple_tag
+def fault_photo_url(photo, size='thumb'):
+    """URL of a fault photo in one of the rendition sizes ('thumb', 'web') or 'original'."""
+    return reverse('haspro_app:fault-photo', args=[photo.pk, size])
@@ -31,11 +31,19 @@ urlpatterns = [
     path('firedistinguisher/<int:pk>/delete/', views.firedistinguisher_delete, name='firedistinguisher-delete'),
 
 	path('tools/', views.tools_view, name='tools-view'),
+	path('tools/import-jobs/', views.import_jobs, name='import-jobs'),
+	path('tools/import-preview/<int:pk>/', views.import_preview, name='import-preview'),
+
+	path('photos/<int:pk>/<str:size>/', views.fault_photo, name='fault-photo'),
 
 	path('import/building_manager/', views.import_building_manager_list, name='import-building-manager-list'),
 	path('import/firedistinguisher/', views.import_firedistinguisher_list, name='import-firedistinguisher-list'),
 
     path('db/dump/snapshot/', views.get_db_snapshot, name='export-db-dump'),
     path('db/inspection/upload/', views.upload_inspection_records, name='upload-inspection-records'),
+    path('db/inspection/upload/session/', views.upload_session_start, name='upload-session-start'),
+    path('db/inspection/upload/session/<int:pk>/', views.upload_session, name='upload-session'),
+    path('db/inspection/upload/session/<int:pk>/finalize/', views.upload_session_finalize, name='upload-session-finalize'),
+    path('db/jobs/<int:pk>/', views.job_status, name='job-status'),
     path('db/csrf/get/', views.get_csrf_token, name='get-csrf-token'),
 ]
@@ -1,12 +1,15 @@
+import hashlib
 import sqlite3
-import tempfile
 import os
-import io
-import datetime
+import zipfile
 
-from django.db import transaction
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.core.files import File
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.utils import timezone
 
+from ..storage import content_sha256
 from ..models import (
     InspectionRecord, 
     FaultInspection, 
@@ -15,9 +18,9 @@ from ..models import (
     Firedistinguisher,
     FiredistinguisherPlacement,
     FiredistinguisherServiceAction,
-    FiredistinguisherServiceActionType,
-    FiredistinguisherKind,
+    UploadReceipt,
 )
+from .recalculation import to_local_date, recalculate_firedistinguishers
 
 
 
@@ -25,6 +28,16 @@ class InspectionImportError(Exception):
     pass
 
 
+# Rows inserted per INSERT statement
+BULK_BATCH_SIZE = 500
+
+# Inspection databases accepted in one zip archive, and bytes extracted from it at once
+ZIP_MAX_FILES = 100
+ZIP_READ_SIZE = 64 * 1024
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
 
 def connect_and_verify_db(file_path):
     try:
@@ -52,22 +65,134 @@ def connect_and_verify_db(file_path):
         raise InspectionImportError(f"Database error: {e}")
 
 
-def _add_inspection_record(obj_map, conn, user, company, db_file_buffer):
+class _InspectionSource:
+    """
+    One inspection database of an upload, open for the whole import.
+    """
+    def __init__(self, name, file, upload_sha256):
+        self.name = name
+        self.file = file
+        self.upload_sha256 = upload_sha256
+        self.conn = None
+        self.tables = None
+        self.photo_column = None
+        self.stored_name = None
+        self.num_imported = 0
+        self.results = []
+
+    def open(self):
+        path = self.file.temporary_file_path()
+        connect_and_verify_db(path)
+        self.conn = sqlite3.connect(path)
+        try:
+            self.tables, self.photo_column = _read_tables(self.conn)
+        except sqlite3.DatabaseError as e:
+            raise InspectionImportError(f"Database error: {e}")
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+
+
+def _read_tables(conn):
+    """
+    Rows of the inspection database. Photos are read without their BLOB, it is streamed
+    into the storage when the photo is imported.
+    """
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM inspection_record")
-    records = cursor.fetchall()
+    tables = {}
+    for table in ("inspection_record", "fault_inspection", "firedistinguisher", "firedistinguisher_placement", "firedistinguisher_service_action"):
+        cursor.execute(f"SELECT * FROM {table}")
+        tables[table] = cursor.fetchall()
+
+    # Column names of the mobile schema, the photos themselves are streamed through blobopen
+    cursor.execute("SELECT * FROM fault_photo LIMIT 0")
+    id_column, fault_column, photo_column, uploaded_at_column = (column[0] for column in cursor.description)
+    cursor.execute(
+        f'SELECT rowid, "{id_column}", "{fault_column}", "{uploaded_at_column}", "{photo_column}" IS NULL FROM fault_photo'
+    )
+    tables["fault_photo"] = cursor.fetchall()
 
-    if len(records) != 1:
-        raise InspectionImportError("The database must contain exactly one inspection record.")
+    return tables, photo_column
 
-    obj_map["InspectionRecord"] = {}
 
-    record = records[0]
-    id, _, date, notes, building_id, created_at, _ = record
+def _split_inspections(tables, current_buildings):
+    """
+    Rows of the database grouped per inspection record:
+    - faults and their photos belong to their inspection
+    - placements belong to the inspection of their building
+    - service actions belong to the inspection of the building the extinguisher is placed in,
+      by the database or, for extinguishers not placed in it, by the server
+    - extinguishers go with the rows referencing them, unreferenced ones with the first inspection
+    A database with one inspection record keeps all rows in it.
+    :param current_buildings: Building of extinguishers known to the server, by their ID in the database.
+    """
+    parts = {
+        record[0]: {
+            "inspection_record": [record],
+            "fault_inspection": [],
+            "fault_photo": [],
+            "firedistinguisher": [],
+            "firedistinguisher_placement": [],
+            "firedistinguisher_service_action": [],
+        }
+        for record in tables["inspection_record"]
+    }
+    if not parts:
+        raise InspectionImportError("The database contains no inspection record.")
+    single_part = next(iter(parts.values())) if len(parts) == 1 else None
+
+    faults = {}
+    for record in tables["fault_inspection"]:
+        inspection_id = record[4]
+        if inspection_id not in parts:
+            raise InspectionImportError(f"Referenced InspectionRecord ID {inspection_id} not found in the imported data.")
+        parts[inspection_id]["fault_inspection"].append(record)
+        faults[record[0]] = parts[inspection_id]
+
+    for record in tables["fault_photo"]:
+        fault_id = record[2]
+        if fault_id not in faults:
+            raise InspectionImportError(f"Referenced FaultInspection ID {fault_id} not found in the imported data.")
+        faults[fault_id]["fault_photo"].append(record)
 
-    building = Building.objects.filter(id=building_id, company=company).first()
+    building_parts = {}
+    for part in parts.values():
+        building_parts.setdefault(part["inspection_record"][0][4], part)
 
-    if not building:
+    firedistinguisher_buildings = dict(current_buildings)
+    for record in tables["firedistinguisher_placement"]:
+        id, _, _, firedistinguisher_id, building_id = record
+        part = single_part or building_parts.get(building_id)
+        if not part:
+            raise InspectionImportError(f"FiredistinguisherPlacement ID {id} is not in an inspected building.")
+        part["firedistinguisher_placement"].append(record)
+        firedistinguisher_buildings[firedistinguisher_id] = building_id
+
+    for record in tables["firedistinguisher_service_action"]:
+        id, firedistinguisher_id = record[:2]
+        part = single_part or building_parts.get(firedistinguisher_buildings.get(firedistinguisher_id))
+        if not part:
+            raise InspectionImportError(f"FiredistinguisherServiceAction ID {id} does not belong to an inspected building.")
+        part["firedistinguisher_service_action"].append(record)
+
+    referenced = set()
+    for part in parts.values():
+        part_ids = {record[3] for record in part["firedistinguisher_placement"]}
+        part_ids |= {record[1] for record in part["firedistinguisher_service_action"]}
+        part["firedistinguisher"] = [record for record in tables["firedistinguisher"] if record[0] in part_ids]
+        referenced |= part_ids
+
+    first_part = next(iter(parts.values()))
+    first_part["firedistinguisher"] += [record for record in tables["firedistinguisher"] if record[0] not in referenced]
+
+    return list(parts.values())
+
+
+def _add_inspection_record(obj_map, part, user, buildings, source):
+    id, _, date, notes, building_id, created_at, _ = part["inspection_record"][0]
+
+    if building_id not in buildings:
         raise InspectionImportError(f"Building with ID {building_id} not found in the current company.")
 
     # Check if the record already exists
@@ -83,40 +208,41 @@ def _add_inspection_record(obj_map, conn, user, company, db_file_buffer):
         notes=notes,
         building_id=building_id,
         created_at=created_at,
-        uploaded_file=File(db_file_buffer)
+        uploaded_file=source.stored_name,  # stored once for all inspections of the database
+        upload_sha256=source.upload_sha256,
+        upload_record_id=id,
     )
-
     inspection.save()
-    
-    # Track the uploaded file for potential cleanup
-    if "uploaded_files" in obj_map and inspection.uploaded_file:
-        obj_map["uploaded_files"].append(inspection.uploaded_file.path)
 
-    obj_map["InspectionRecord"][id] = inspection
+    obj_map["InspectionRecord"] = {id: inspection}
     
     return 1
 
 
 
-def _add_fault_records(obj_map, conn):
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM fault_inspection")
-    records = cursor.fetchall()
-    
-    num_updated = 0
+class _BlobFile(File):
+    """
+    A BLOB of the inspection database, read by the storage in chunks instead of all at once.
+    """
+    def __init__(self, blob):
+        super().__init__(blob)
+        self.size = len(blob)
 
+    @property
+    def closed(self):
+        return False
+
+
+def _add_fault_records(obj_map, part, source):
     obj_map["FaultInspection"] = {}
-    for record in records:
+    for record in part["fault_inspection"]:
         id, fault_id, short_name, description, inspection_id, notes, responsible_person, fix_due_date, resolved, present = record
 
         if fix_due_date and len(fix_due_date) > 10:
             fix_due_date = fix_due_date[:10]
 
-        if inspection_id not in obj_map["InspectionRecord"]:
-            raise InspectionImportError(f"Referenced InspectionRecord ID {inspection_id} not found in the imported data.")
-
         # Create new FaultInspection
-        fault_inspection = FaultInspection(
+        obj_map["FaultInspection"][id] = FaultInspection(
             fault_id=fault_id,
             short_name=short_name,
             description=description,
@@ -127,53 +253,40 @@ def _add_fault_records(obj_map, conn):
             resolved=resolved,
             present=present
         )
-        fault_inspection.save()
 
-        obj_map["FaultInspection"][id] = fault_inspection
-        num_updated += 1
-
-    cursor.execute("SELECT * FROM fault_photo")
-    records = cursor.fetchall()
+    FaultInspection.objects.bulk_create(obj_map["FaultInspection"].values(), batch_size=BULK_BATCH_SIZE)
+    num_updated = len(obj_map["FaultInspection"])
 
     obj_map["FaultPhoto"] = {}
 
-    for record in records:
-        id, fault_id, photo, uploaded_at = record
-
-        if fault_id not in obj_map["FaultInspection"]:
-            raise InspectionImportError(f"Referenced FaultInspection ID {fault_id} not found in the imported data.")
-
-        # Create new File
-        photo_file = File(io.BytesIO(photo))
-        photo_file.name = f"fault_{fault_id:04d}_photo_{id:04d}.jpg"
+    for rowid, id, fault_id, uploaded_at, missing_photo in part["fault_photo"]:
+        if missing_photo:
+            raise InspectionImportError(f"FaultPhoto ID {id} contains no image.")
 
         fault_photo = FaultPhoto(
             fault_inspection=obj_map["FaultInspection"].get(fault_id),
-            photo=photo_file,
             uploaded_at=uploaded_at
         )
-        fault_photo.save()
-        
-        # Track the uploaded file for potential cleanup
-        if "uploaded_files" in obj_map and fault_photo.photo:
-            obj_map["uploaded_files"].append(fault_photo.photo.path)
-        
-        obj_map["FaultPhoto"][id] = fault_photo
+        with source.conn.blobopen("fault_photo", source.photo_column, rowid, readonly=True) as blob:
+            fault_photo.photo.save(f"fault_{fault_id:04d}_photo_{id:04d}.jpg", _BlobFile(blob), save=False)
 
-    return num_updated
+        obj_map["FaultPhoto"][id] = fault_photo
 
-def _add_new_firedistinguisher(obj_map, conn, company):
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM firedistinguisher")
-    records = cursor.fetchall()
+    FaultPhoto.objects.bulk_create(obj_map["FaultPhoto"].values(), batch_size=BULK_BATCH_SIZE)
 
-    num_updated = 0
+    return num_updated
 
+def _add_new_firedistinguisher(obj_map, part, company, existing):
+    """
+    :param existing: Extinguishers already on the server by serial number, not changed here,
+    the created ones are collected in obj_map["NewFiredistinguisher"] until the import is committed.
+    """
     obj_map["Firedistinguisher"] = {}
-    for record in records:
+    obj_map["NewFiredistinguisher"] = {}
+    for record in part["firedistinguisher"]:
         id, kind, size, power, manufacturer, serial_number, eliminated, manufactured_year, managed_by_id, next_inspection = record
 
-        fd = Firedistinguisher.objects.filter(serial_number=serial_number).first()
+        fd = existing.get(serial_number) or obj_map["NewFiredistinguisher"].get(serial_number)
         if fd:
             obj_map["Firedistinguisher"][id] = fd
             continue  # Skip existing
@@ -190,53 +303,42 @@ def _add_new_firedistinguisher(obj_map, conn, company):
             managed_by=company,
             next_inspection=next_inspection
         )
-        fd.save()
+        obj_map["NewFiredistinguisher"][serial_number] = fd
 
         obj_map["Firedistinguisher"][id] = fd
-        num_updated += 1
 
-    return num_updated
+    Firedistinguisher.objects.bulk_create(obj_map["NewFiredistinguisher"].values(), batch_size=BULK_BATCH_SIZE)
 
-def _add_firedistinguisher_placements(obj_map, conn):
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM firedistinguisher_placement")
-    records = cursor.fetchall()
-
-    num_updated = 0
+    return len(obj_map["NewFiredistinguisher"])
 
+def _add_firedistinguisher_placements(obj_map, part):
     obj_map["FiredistinguisherPlacement"] = {}
-    for record in records:
+    for record in part["firedistinguisher_placement"]:
         id, description, created_at, firedistinguisher_id, building_id = record
 
         if firedistinguisher_id in obj_map["Firedistinguisher"]:
             firedistinguisher_id = obj_map["Firedistinguisher"].get(firedistinguisher_id).pk
 
         # Create new FiredistinguisherPlacement
-        fdp = FiredistinguisherPlacement(
+        obj_map["FiredistinguisherPlacement"][id] = FiredistinguisherPlacement(
             description=description,
             created_at=created_at,
             firedistinguisher_id=firedistinguisher_id,
             building_id=building_id
         )
-        fdp.save()
 
-        obj_map["FiredistinguisherPlacement"][id] = fdp
-        num_updated += 1
+    FiredistinguisherPlacement.objects.bulk_create(obj_map["FiredistinguisherPlacement"].values(), batch_size=BULK_BATCH_SIZE)
 
-    return num_updated
+    return len(obj_map["FiredistinguisherPlacement"])
 
 
-def _add_firedistinguisher_inspections(obj_map, conn):
+def _add_firedistinguisher_inspections(obj_map, part):
     
-    inspection_id = list(obj_map.get("InspectionRecord", {}).keys())[0]  # There should be only one inspection record
+    inspection_id = list(obj_map.get("InspectionRecord", {}).values())[0].pk  # There is one inspection record per part
     num_updated = 0
 
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM firedistinguisher_service_action")
-    records = cursor.fetchall()
-
     obj_map["FiredistinguisherServiceAction"] = {}
-    for record in records:
+    for record in part["firedistinguisher_service_action"]:
         id, firedistinguisher_id, action_type, description, created_at = record
 
         if firedistinguisher_id not in obj_map["Firedistinguisher"]:
@@ -244,110 +346,346 @@ def _add_firedistinguisher_inspections(obj_map, conn):
 
         fd = obj_map["Firedistinguisher"].get(firedistinguisher_id)
 
-        service_action = FiredistinguisherServiceAction(
+        obj_map["FiredistinguisherServiceAction"][id] = FiredistinguisherServiceAction(
             firedistinguisher=fd,
             action_type=action_type,
             description=description,
             created_at=created_at,
             inspection_id=inspection_id
         )
-        service_action.save()
-        obj_map["FiredistinguisherServiceAction"][id] = service_action
+
+    FiredistinguisherServiceAction.objects.bulk_create(obj_map["FiredistinguisherServiceAction"].values(), batch_size=BULK_BATCH_SIZE)
 
     return num_updated
 
 
 
-def _update_firedistinguisher_next_inspection(obj_map):
-    for fda in obj_map.get("FiredistinguisherServiceAction", {}).values():
-        if fda.action_type == FiredistinguisherServiceActionType.INSPECTION:
-            fd = Firedistinguisher.objects.filter(id=fda.firedistinguisher.id).first()
-            fd.next_inspection = fda.created_at + datetime.timedelta(days=365)  # Set next inspection one year later
-            fd.save()
-
-        elif fda.action_type == FiredistinguisherServiceActionType.ELIMINATION:
-            fd = Firedistinguisher.objects.filter(id=fda.firedistinguisher.id).first()
-            fd.eliminated = True
-            fd.next_inspection = None
-            fd.next_periodic_test = None
-            fd.save()
-
-        elif fda.action_type == FiredistinguisherServiceActionType.PERIODIC_TEST:
-            fd = Firedistinguisher.objects.filter(id=fda.firedistinguisher.id).first()
-            fd.next_inspection = fda.created_at + datetime.timedelta(days=365)  # Set next inspection one year later
-            if fd.kind == FiredistinguisherKind.WATER or fd.kind == FiredistinguisherKind.FOAM:
-                fd.next_periodic_test = fda.created_at + datetime.timedelta(days=365 * 3)  # Set next periodic test three years later
-            else:
-                fd.next_periodic_test = fda.created_at + datetime.timedelta(days=365 * 5)  # Set next periodic test five years later
-            fd.save()
-    
-    building = Building.objects.filter(id=obj_map.get("InspectionRecord", {}).get(1).building.id).first()
-    if building:
-        building.last_inspection_date = obj_map.get("InspectionRecord", {}).get(1).date
-        building.save()
+def _update_firedistinguisher_next_inspection(firedistinguisher_ids, inspections, buildings):
+    """
+    Recalculate the schedule of the serviced extinguishers and the last inspection date of the inspected buildings.
+    """
+    recalculate_firedistinguishers(firedistinguisher_ids)
+
+    now = timezone.now()
+    inspected = {}
+    for inspection in inspections:
+        building = buildings[inspection.building_id]
+        building.last_inspection_date = max(filter(None, (inspected.get(building), to_local_date(inspection.date))))
+        building.updated_at = now  # bulk_update() skips auto_now
+        inspected[building] = building.last_inspection_date
+    Building.objects.bulk_update(inspected.keys(), ['last_inspection_date', 'updated_at'])
 
 
-def add_inspection(user, company, file):
+class SpooledFile(File):
+    """
+    A file on disk consumed by the import. The storage moves it into place instead of copying it.
+    """
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def _spool_upload(file):
+    """
+    The upload as a file on disk. Uploads over FILE_UPLOAD_MAX_MEMORY_SIZE are already streamed
+    to a temporary file by Django, smaller ones are written out chunk by chunk.
+    The storage moves such a file into place instead of copying it.
+    """
+    if hasattr(file, "temporary_file_path"):
+        return file
+
+    spool = TemporaryUploadedFile(
+        os.path.basename(file.name),
+        getattr(file, "content_type", None),
+        file.size,
+        getattr(file, "charset", None),
+    )
+    try:
+        for chunk in file.chunks():
+            spool.write(chunk)
+        spool.flush()
+    except Exception:
+        spool.close()
+        raise
+    return spool
+
+
+def _extract_zip(spool):
+    """
+    The inspection databases of a zip archive, each extracted to its own spool file
+    and hashed like a separate upload.
+    """
+    try:
+        with zipfile.ZipFile(spool.temporary_file_path()) as archive:
+            members = [member for member in archive.infolist() if not member.is_dir() and not member.filename.startswith("__MACOSX/")]
+            if len(members) > ZIP_MAX_FILES:
+                raise InspectionImportError(f"The archive may contain at most {ZIP_MAX_FILES} files.")
+            if any(member.file_size > settings.UPLOAD_SESSION_MAX_SIZE for member in members):
+                raise InspectionImportError("The archive contains a file that is too large.")
+
+            sources = []
+            try:
+                for member in members:
+                    name = os.path.basename(member.filename)
+                    extracted = TemporaryUploadedFile(name, None, member.file_size, None)
+                    sources.append(_InspectionSource(name, extracted, None))
+                    upload_sha256 = hashlib.sha256()
+                    with archive.open(member) as f:
+                        while chunk := f.read(ZIP_READ_SIZE):
+                            extracted.write(chunk)
+                            upload_sha256.update(chunk)
+                    extracted.flush()
+                    sources[-1].upload_sha256 = upload_sha256.hexdigest()
+            except Exception:
+                for source in sources:
+                    source.file.close()
+                raise
+            return sources
+    except zipfile.BadZipFile as e:
+        raise InspectionImportError(f"Invalid zip archive: {e}")
+
+
+def get_upload_sha256(file):
+    """
+    SHA-256 of an uploaded file, computed by the upload handler while the file was received,
+    or read in chunks for files from elsewhere. Kept on the file, the storage names the file by it.
+    """
+    file.sha256 = content_sha256(file)
+    return file.sha256
+
+
+def find_imported_upload(upload_sha256):
+    """
+    The results of each inspection record of an earlier import of the same file,
+    None unless all records of the file were imported.
+    """
+    receipt = UploadReceipt.objects.filter(upload_sha256=upload_sha256).first()
+    return receipt.results if receipt else None
+
+
+def _store_receipts(parts):
+    # Written with the records, a retried upload is answered from the receipt only once the whole file is in
+    for source in dict.fromkeys(source for source, _ in parts):
+        if len(source.results) == len(source.tables["inspection_record"]) and all(result["success"] for result in source.results):
+            UploadReceipt.objects.get_or_create(upload_sha256=source.upload_sha256, defaults={"results": source.results})
+
+
+def _inspection_result(source, record=None, error=None):
+    result = {
+        "file": source.name,
+        "inspection_id": record[0] if record else None,
+        "building_id": record[4] if record else None,
+        "success": error is None,
+    }
+    if error is None:
+        result["updated_count"] = 1
+    else:
+        result["error"] = error
+    return result
+
+
+def _current_buildings(sources, existing):
+    """
+    Building each extinguisher known to the server is placed in, by source and ID in its database.
+    """
+    sources = [source for source in sources if len(source.tables["inspection_record"]) > 1]
+    serial_numbers = {record[5] for source in sources for record in source.tables["firedistinguisher"]} & existing.keys()
+    if not serial_numbers:
+        return {}
+
+    fd_buildings = {}
+    placements = (
+        FiredistinguisherPlacement.objects
+        .filter(firedistinguisher__in=[existing[serial_number].pk for serial_number in serial_numbers])
+        .order_by('firedistinguisher', '-created_at', '-id')
+        .values_list('firedistinguisher', 'building')
+    )
+    for fd_id, building_id in placements:
+        fd_buildings.setdefault(fd_id, building_id)
+
+    return {
+        source: {
+            record[0]: fd_buildings[existing[record[5]].pk]
+            for record in source.tables["firedistinguisher"]
+            if record[5] in serial_numbers and existing[record[5]].pk in fd_buildings
+        }
+        for source in sources
+    }
+
+
+def _import_sources(user, company, sources, progress=None, single=False):
+    """
+    Import the inspection records of the databases. Buildings, serial numbers and earlier imports
+    are looked up once for all of them and each inspection record is imported in its own savepoint,
+    so a failing record does not stop the others.
+    :param single: Accept only databases with exactly one inspection record.
+    :return: The result of each inspection record (or of a database that could not be read).
+    """
+    parts = []
+    opened = []
+    try:
+        for source in sources:
+            try:
+                source.open()
+                opened.append(source)
+                if single and len(source.tables["inspection_record"]) != 1:
+                    raise InspectionImportError("The database must contain exactly one inspection record.")
+            except InspectionImportError as e:
+                source.results.append(_inspection_result(source, error=str(e)))
+        if progress:
+            progress(10)
+
+        # Shared lookups of all databases
+        building_ids = {record[4] for source in opened for record in source.tables["inspection_record"]}
+        buildings = {building.pk: building for building in Building.objects.filter(id__in=building_ids, company=company)}
+
+        # Resolve all serial numbers with one query, the oldest record wins for duplicates
+        existing = {}
+        serial_numbers = {record[5] for source in opened for record in source.tables["firedistinguisher"]}
+        for fd in Firedistinguisher.objects.filter(serial_number__in=serial_numbers).order_by('pk'):
+            existing.setdefault(fd.serial_number, fd)
+
+        imported = set(
+            InspectionRecord.objects
+            .filter(upload_sha256__in={source.upload_sha256 for source in opened})
+            .values_list('upload_sha256', 'upload_record_id')
+        )
+
+        current_buildings = _current_buildings(opened, existing)
+        for source in opened:
+            if single and len(source.tables["inspection_record"]) != 1:
+                continue
+            try:
+                parts.extend((source, part) for part in _split_inspections(source.tables, current_buildings.get(source, {})))
+            except InspectionImportError as e:
+                source.results.append(_inspection_result(source, error=str(e)))
+
+        _import_parts(user, company, parts, buildings, existing, imported)
+        return [result for source in sources for result in source.results]
+    finally:
+        for source in opened:
+            source.close()
+
+
+def _import_parts(user, company, parts, buildings, existing, imported):
+    """
+    Import the inspection records, each in its own savepoint, adding their results to their source.
+    """
+    # Files stored for records that are rolled back are left to `collect_orphaned_media`, an import
+    # running at once may store the same content and reference it
+    field = InspectionRecord._meta.get_field("uploaded_file")
+    firedistinguisher_ids = set()
+    inspections = []
+    with transaction.atomic():
+        for source, part in parts:
+            record = part["inspection_record"][0]
+            if (source.upload_sha256, record[0]) in imported:
+                # A retried upload
+                source.results.append(_inspection_result(source, record))
+                continue
+
+            # The database is stored once, with its first inspection record
+            if source.stored_name is None:
+                source.file.sha256 = source.upload_sha256  # Names the stored file, no need to hash it again
+                source.stored_name = field.storage.save(field.generate_filename(None, source.name), source.file, max_length=field.max_length)
+
+            try:
+                with transaction.atomic():
+                    obj_map = {}
+                    _add_inspection_record(obj_map, part, user, buildings, source)
+                    _add_fault_records(obj_map, part, source)
+                    _add_new_firedistinguisher(obj_map, part, company, existing)
+                    _add_firedistinguisher_placements(obj_map, part)
+                    _add_firedistinguisher_inspections(obj_map, part)
+            except InspectionImportError as e:
+                source.results.append(_inspection_result(source, record, error=str(e)))
+                continue
+            except IntegrityError:
+                # The same record imported by a concurrent request
+                if not InspectionRecord.objects.filter(upload_sha256=source.upload_sha256, upload_record_id=record[0]).exists():
+                    raise
+                source.results.append(_inspection_result(source, record))
+                continue
+
+            existing.update(obj_map["NewFiredistinguisher"])
+            firedistinguisher_ids |= {fda.firedistinguisher_id for fda in obj_map["FiredistinguisherServiceAction"].values()}
+            inspections.extend(obj_map["InspectionRecord"].values())
+            source.num_imported += 1
+            source.results.append(_inspection_result(source, record))
+
+        _update_firedistinguisher_next_inspection(firedistinguisher_ids, inspections, buildings)
+        _store_receipts(parts)
+
+
+def add_inspection(user, company, file, progress=None):
     """
     Add inspection data from an uploaded SQLite database file.
     - accepts only one inspection record
     - all referenced buildings must exist in the current company
     - if the inspection record already exists (same date and building), it is skipped
+    - if the same file was already imported completely (a retried upload), the earlier result is returned
     - if the inspector does not match the current user, an error is raised
     :param user: The user performing the import.
     :param company: The company associated with the import.
     :param file: The uploaded file object (should be a SQLite database).
+    :param progress: Optional callable receiving the completed percentage, called outside the import transaction.
     :return: A tuple (num_updated, error_message). If error_message is None,
     """
 
-    # Create a temporary file that won't be auto-deleted
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        temp_file.write(file.read())
-        temp_file.flush()  # Ensure data is written to disk
-        temp_filename = temp_file.name
+    upload_sha256 = get_upload_sha256(file)
+    previous_results = find_imported_upload(upload_sha256)
+    # A file of several records imported with the batch upload is refused like on its first upload
+    if previous_results and len(previous_results) == 1:
+        return previous_results[0]["updated_count"], None
 
-    # Track uploaded files for cleanup on failure
-    uploaded_files = []
-    
+    spool = _spool_upload(file)
     try:
-        connect_and_verify_db(temp_filename)
-
-        with sqlite3.connect(temp_filename) as conn:
-            with transaction.atomic():
-                obj_map = {"uploaded_files": uploaded_files}  # Pass the list to track files
-                _add_inspection_record(obj_map, conn, user, company, file)
-                _add_fault_records(obj_map, conn)
-                _add_new_firedistinguisher(obj_map, conn, company)
-                _add_firedistinguisher_placements(obj_map, conn)
-                _add_firedistinguisher_inspections(obj_map, conn)
-                
-        _update_firedistinguisher_next_inspection(obj_map)
-
-        # If we get here, transaction was successful
-        return len(obj_map.get("InspectionRecord", {})), None
-        
-    except InspectionImportError as e:
-        # Clean up uploaded files if transaction fails
-        for file_path in uploaded_files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except OSError:
-                pass  # Ignore cleanup errors
-        return 0, str(e)
-    except Exception as e:
-        # Clean up uploaded files if transaction fails  
-        for file_path in uploaded_files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except OSError:
-                pass  # Ignore cleanup errors
-        raise e
+        source = _InspectionSource(os.path.basename(file.name), spool, upload_sha256)
+        result = _import_sources(user, company, [source], progress, single=True)[0]
     finally:
-        # Clean up the temporary file
-        if os.path.exists(temp_filename):
-            os.remove(temp_filename)
+        # Clean up the spool file unless it was moved into the storage
+        if spool is not file:
+            spool.close()
 
+    if not result["success"]:
+        return 0, result["error"]
+    return result["updated_count"], None
 
 
+def add_inspection_batch(user, company, file, progress=None):
+    """
+    Add the inspection records of an uploaded SQLite database, or of a zip archive of several.
+    Each inspection record is imported on its own, one that fails does not stop the others.
+    Records of a database imported before (also as a separate upload) are not imported again.
+    :param progress: Optional callable receiving the completed percentage, called outside the import transaction.
+    :return: A dict with `success` (all records imported), the total `updated_count` and `results`
+    with the outcome of each inspection record, or an `error` when the upload cannot be read at all.
+    """
+    spool = _spool_upload(file)
+    sources = []
+    try:
+        with open(spool.temporary_file_path(), "rb") as f:
+            is_database = f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+        if is_database:
+            sources = [_InspectionSource(os.path.basename(file.name), spool, get_upload_sha256(file))]
+        else:
+            sources = _extract_zip(spool)
+            if not sources:
+                raise InspectionImportError("The archive contains no inspection database.")
+
+        results = _import_sources(user, company, sources, progress)
+    except InspectionImportError as e:
+        return {"success": False, "error": str(e), "updated_count": 0, "results": []}
+    finally:
+        # Clean up the spool files unless they were moved into the storage
+        for source in sources:
+            if source.file is not spool:
+                source.file.close()
+        if spool is not file:
+            spool.close()
+
+    return {
+        "success": all(result["success"] for result in results),
+        "updated_count": sum(result.get("updated_count", 0) for result in results),
+        "results": results,
+    }
@@ -1,35 +1,64 @@
 import sqlite3
-import io
+import os
+import glob
+import gzip
+import shutil
+import hashlib
 import tempfile
+import datetime
+
+from django.conf import settings
+from django.db.models import Count, Max, OuterRef, Q, Subquery
+from django.utils import timezone
 
 from haspro_app.models import (
     Company,
-    BuildingOwner, 
-    BuildingManager, 
-    Building, 
-    Fault, 
+    BuildingOwner,
+    BuildingManager,
+    Building,
+    Fault,
     PossibleFault,
-    Firedistinguisher, 
+    Firedistinguisher,
     FiredistinguisherPlacement,
     FiredistinguisherServiceAction,
+    DeletedRecord,
 )
+from haspro_app.utils.locks import file_lock, limited_slots
 
-def export_project_to_sqlite(company, file_name):
-    # Query all related records
-    owners = BuildingOwner.objects.filter(managed_by=company)
-    managers = BuildingManager.objects.all()
-    buildings = Building.objects.filter(company=company)
-    faults = Fault.objects.all()
-    possible_faults = PossibleFault.objects.filter(building__in=buildings)
-    firedistinguishers = Firedistinguisher.objects.filter(managed_by=company)
-    placements = FiredistinguisherPlacement.objects.filter(firedistinguisher__in=firedistinguishers)
-    service_actions = FiredistinguisherServiceAction.objects.filter(firedistinguisher__in=firedistinguishers)
 
-    # Create SQLite DB
-    conn = sqlite3.connect(file_name)
-    c = conn.cursor()
+SYNC_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# Schema version of the exported file, stored in its database_version table and user_version pragma.
+# Bump whenever the layout or content of the file changes, this also invalidates cached snapshots.
+SNAPSHOT_FORMAT_VERSION = 3
+
+# Supported snapshot compressions in order of preference, with the suffix of the cached files
+SNAPSHOT_ENCODINGS = ('gzip',)
+SNAPSHOT_ENCODING_SUFFIXES = {
+    'gzip': '.gz',
+}
+GZIP_LEVEL = 6
+
+# History of service actions included in partial (route) snapshots
+PARTIAL_SNAPSHOT_ACTION_DAYS = 2 * 365
+
+
+def format_sync_cursor(moment):
+    return moment.astimezone(datetime.timezone.utc).strftime(SYNC_CURSOR_FORMAT)
+
 
-    # Create tables
+def parse_sync_cursor(cursor):
+    """
+    Parse a cursor previously handed out by the snapshot endpoint.
+    :raises ValueError: if the cursor is malformed.
+    """
+    moment = datetime.datetime.fromisoformat(cursor)
+    if timezone.is_naive(moment):
+        raise ValueError("Sync cursor must contain a timezone.")
+    return moment
+
+
+def _create_tables(c):
     c.execute('''CREATE TABLE company (
         id INTEGER PRIMARY KEY,
         name TEXT,
@@ -117,37 +146,227 @@ def export_project_to_sqlite(company, file_name):
               created_at TEXT,
               updated_at TEXT
     )''')
+    c.execute('''CREATE TABLE deleted_record (
+        id INTEGER PRIMARY KEY,
+        table_name TEXT,
+        record_id INTEGER,
+        deleted_at TEXT
+    )''')
+    c.execute('''CREATE TABLE current_placement (
+        firedistinguisher INTEGER PRIMARY KEY,
+        placement INTEGER,
+        building INTEGER,
+        description TEXT,
+        created_at TEXT
+    )''')
+    c.execute('''CREATE TABLE database_version (
+        version INTEGER
+    )''')
+    c.execute('''CREATE TABLE sync_info (
+        cursor TEXT,
+        since TEXT,
+        is_delta INTEGER,
+        is_partial INTEGER
+    )''')
+
+
+def _create_indexes(c):
+    # Created after the rows are inserted, which is faster than maintaining them row by row
+    c.execute('CREATE INDEX building_owner_idx ON building (owner)')
+    c.execute('CREATE INDEX possible_fault_building_idx ON possible_fault (building)')
+    c.execute('CREATE INDEX firedistinguisher_serial_number_idx ON firedistinguisher (serial_number)')
+    c.execute('CREATE INDEX firedistinguisher_placement_building_idx ON firedistinguisher_placement (building)')
+    c.execute('CREATE INDEX firedistinguisher_placement_firedistinguisher_idx ON firedistinguisher_placement (firedistinguisher, created_at)')
+    c.execute('CREATE INDEX firedistinguisher_service_action_firedistinguisher_idx ON firedistinguisher_service_action (firedistinguisher, created_at)')
+    c.execute('CREATE INDEX current_placement_building_idx ON current_placement (building)')
+
+
+def _fill_current_placements(c):
+    # Latest placement of every exported extinguisher, so the app does not have to find it on the device
+    c.execute('''INSERT INTO current_placement
+        SELECT p.firedistinguisher, p.id, p.building, p.description, p.created_at
+        FROM firedistinguisher_placement p
+        WHERE p.id = (
+            SELECT latest.id FROM firedistinguisher_placement latest
+            WHERE latest.firedistinguisher = p.firedistinguisher
+            ORDER BY latest.created_at DESC, latest.id DESC
+            LIMIT 1
+        )''')
+
+
+def _company_querysets(company, buildings=None):
+    """
+    Querysets of the rows exported for the company, keyed by table name.
+    :param buildings: Optional queryset of the company buildings to limit the export to. Only
+        the extinguishers currently placed in them, their latest placements and recent service
+        actions are exported then.
+    """
+    if buildings is None:
+        firedistinguishers = Firedistinguisher.objects.filter(managed_by=company)
+        buildings = Building.objects.filter(company=company)
+        return {
+            "company": Company.objects.filter(pk=company.pk),
+            "building_owner": BuildingOwner.objects.filter(managed_by=company),
+            "building_manager": BuildingManager.objects.all(),
+            "building": buildings,
+            "fault": Fault.objects.all(),
+            "possible_fault": PossibleFault.objects.filter(building__in=buildings),
+            "firedistinguisher": firedistinguishers,
+            "firedistinguisher_placement": FiredistinguisherPlacement.objects.filter(firedistinguisher__in=firedistinguishers),
+            "firedistinguisher_service_action": FiredistinguisherServiceAction.objects.filter(firedistinguisher__in=firedistinguishers),
+        }
+
+    latest_placements = FiredistinguisherPlacement.objects.filter(
+        firedistinguisher=OuterRef('firedistinguisher')
+    ).order_by('-created_at', '-id')
+    current_placements = FiredistinguisherPlacement.objects.filter(
+        firedistinguisher__managed_by=company,
+        building__in=buildings,
+        pk=Subquery(latest_placements.values('pk')[:1]),
+    )
+    firedistinguishers = Firedistinguisher.objects.filter(managed_by=company, pk__in=current_placements.values('firedistinguisher'))
+    actions_since = timezone.now() - datetime.timedelta(days=PARTIAL_SNAPSHOT_ACTION_DAYS)
+
+    return {
+        "company": Company.objects.filter(pk=company.pk),
+        "building_owner": BuildingOwner.objects.filter(managed_by=company),
+        "building_manager": BuildingManager.objects.filter(pk__in=buildings.values('manager')),
+        "building": buildings,
+        "fault": Fault.objects.all(),
+        "possible_fault": PossibleFault.objects.filter(building__in=buildings),
+        "firedistinguisher": firedistinguishers,
+        "firedistinguisher_placement": current_placements,
+        "firedistinguisher_service_action": FiredistinguisherServiceAction.objects.filter(
+            firedistinguisher__in=firedistinguishers, created_at__gte=actions_since),
+    }
+
+
+def select_route_buildings(company, building_ids=None, due_within_days=None):
+    """
+    Select the company buildings for a partial snapshot.
+    :param building_ids: Only buildings with these primary keys.
+    :param due_within_days: Only buildings never inspected or whose next inspection
+        (last_inspection_date + inspection_interval_days) is due within this many days.
+    :return: A queryset of the selected buildings.
+    """
+    buildings = Building.objects.filter(company=company)
+    if building_ids is not None:
+        buildings = buildings.filter(pk__in=building_ids)
+
+    if due_within_days is not None:
+        horizon = timezone.localdate() + datetime.timedelta(days=due_within_days)
+        # Date arithmetic is not portable across databases, so compare per inspection interval
+        due = Q(last_inspection_date__isnull=True)
+        for interval in buildings.order_by().values_list('inspection_interval_days', flat=True).distinct():
+            due |= Q(inspection_interval_days=interval, last_inspection_date__lte=horizon - datetime.timedelta(days=interval))
+        buildings = buildings.filter(due)
+
+    return buildings
+
+
+# Exported columns of each table, in the order of the CREATE TABLE statements above
+_TABLE_COLUMNS = {
+    "company": ('id', 'name', 'address', 'city', 'zipcode', 'ico', 'dic', 'logo'),
+    "building_owner": ('id', 'name', 'address', 'city', 'zipcode', 'ico', 'dic', 'managed_by'),
+    "building_manager": ('id', 'name', 'address', 'phone', 'phone2', 'email'),
+    "building": ('id', 'building_id', 'address', 'city', 'zipcode', 'note', 'company', 'owner', 'manager', 'last_inspection_date', 'inspection_interval_days'),
+    "fault": ('id', 'short_name', 'description', 'default_fix_time_days'),
+    "possible_fault": ('id', 'fault', 'building'),
+    "firedistinguisher": ('id', 'kind', 'size', 'power', 'manufacturer', 'serial_number', 'eliminated', 'manufactured_year', 'managed_by', 'next_inspection', 'next_periodic_test'),
+    "firedistinguisher_placement": ('id', 'description', 'created_at', 'firedistinguisher', 'building'),
+    "firedistinguisher_service_action": ('id', 'action_type', 'description', 'created_at', 'firedistinguisher'),
+}
+
+
+def _to_text(value):
+    return str(value) if value is not None else None
+
+
+# Conversions of raw column values into the text form the mobile app expects
+_COLUMN_CONVERTERS = {
+    "company": {'logo': lambda value: value or ''},
+    "building": {'last_inspection_date': _to_text},
+    "firedistinguisher": {'next_inspection': _to_text, 'next_periodic_test': _to_text},
+    "firedistinguisher_placement": {'created_at': _to_text},
+    "firedistinguisher_service_action": {'created_at': _to_text},
+}
+
+# Rows fetched from the database per round trip while exporting
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _table_rows(table, queryset):
+    columns = _TABLE_COLUMNS[table]
+    rows = queryset.order_by().values_list(*columns).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    converters = [(columns.index(column), converter) for column, converter in _COLUMN_CONVERTERS.get(table, {}).items()]
+    if not converters:
+        return rows
+
+    def convert(row):
+        row = list(row)
+        for idx, converter in converters:
+            row[idx] = converter(row[idx])
+        return row
+
+    return map(convert, rows)
+
+
+def _company_deleted_records(company):
+    # Tombstones of shared tables have no company and go to every client
+    return DeletedRecord.objects.filter(Q(company_id=company.pk) | Q(company_id__isnull=True))
+
+
+def export_project_to_sqlite(company, file_name, since=None, buildings=None):
+    """
+    Export the company data for the mobile app into a new SQLite database.
+    :param company: The company to export.
+    :param file_name: Path of the SQLite file to create.
+    :param since: If given, only rows changed after this moment are exported together
+        with the records deleted since then (delta snapshot).
+    :param buildings: If given, a queryset of buildings to limit the export to (partial snapshot).
+    :return: The sync cursor the client should send to get the next delta.
+    """
+    # Taken before querying and moved back by the overlap, a transaction may stamp rows with an earlier
+    # time than the cursor and commit only after the export read them. Those rows are sent again next time,
+    # the app applies snapshot rows as upserts by primary key.
+    cursor = format_sync_cursor(timezone.now() - datetime.timedelta(seconds=settings.SYNC_CURSOR_OVERLAP))
+
+    querysets = _company_querysets(company, buildings=buildings)
+    deleted_records = DeletedRecord.objects.none()
+    if since is not None:
+        querysets = {table: qs.filter(updated_at__gte=since) for table, qs in querysets.items()}
+        deleted_records = _company_deleted_records(company).filter(deleted_at__gte=since)
+
+    # Create SQLite DB. The file is thrown away on failure, so durability is not needed
+    conn = sqlite3.connect(file_name, isolation_level=None)
+    c = conn.cursor()
+    c.execute('PRAGMA journal_mode = OFF')
+    c.execute('PRAGMA synchronous = OFF')
+    c.execute('BEGIN')
+
+    _create_tables(c)
 
     # Insert data
-    c.execute('INSERT INTO company VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
-        company.id, company.name, company.address, company.city, company.zipcode, company.ico, company.dic, str(company.logo)])
-    for obj in owners:
-        c.execute('INSERT INTO building_owner VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
-            obj.id, obj.name, obj.address, obj.city, obj.zipcode, obj.ico, obj.dic, obj.managed_by_id])
-    for obj in managers:
-        c.execute('INSERT INTO building_manager VALUES (?, ?, ?, ?, ?, ?)', [
-            obj.id, obj.name, obj.address, obj.phone, obj.phone2, obj.email])
-    for obj in buildings:
-        c.execute('INSERT INTO building VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
-            obj.id, obj.building_id, obj.address, obj.city, obj.zipcode, obj.note, obj.company_id, obj.owner_id, obj.manager_id, obj.last_inspection_date, obj.inspection_interval_days])
-    for obj in faults:
-        c.execute('INSERT INTO fault VALUES (?, ?, ?, ?)', [
-            obj.id, obj.short_name, obj.description, obj.default_fix_time_days])
-    for obj in possible_faults:
-        c.execute('INSERT INTO possible_fault VALUES (?, ?, ?)', [
-            obj.id, obj.fault_id, obj.building_id])
-    for obj in firedistinguishers:
-        c.execute('INSERT INTO firedistinguisher VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
-            obj.id, obj.kind, obj.size, obj.power, obj.manufacturer, obj.serial_number, int(obj.eliminated), obj.manufactured_year, obj.managed_by_id, obj.next_inspection, obj.next_periodic_test])
-    for obj in placements:
-        c.execute('INSERT INTO firedistinguisher_placement VALUES (?, ?, ?, ?, ?)', [
-            obj.id, obj.description, str(obj.created_at), obj.firedistinguisher_id, obj.building_id])
-    for obj in service_actions:
-        c.execute('INSERT INTO firedistinguisher_service_action VALUES (?, ?, ?, ?, ?)', [
-            obj.id, obj.action_type, obj.description, str(obj.created_at), obj.firedistinguisher_id])
+    for table, queryset in querysets.items():
+        placeholders = ", ".join("?" * len(_TABLE_COLUMNS[table]))
+        c.executemany(f'INSERT INTO {table} VALUES ({placeholders})', _table_rows(table, queryset))
+
+    _create_indexes(c)
+    _fill_current_placements(c)
+
+    c.executemany('INSERT INTO deleted_record VALUES (?, ?, ?, ?)', (
+        (obj_id, table_name, record_id, format_sync_cursor(deleted_at))
+        for obj_id, table_name, record_id, deleted_at in deleted_records.values_list('id', 'table_name', 'record_id', 'deleted_at').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    ))
+
+    c.execute('INSERT INTO database_version VALUES (?)', [SNAPSHOT_FORMAT_VERSION])
+    c.execute(f'PRAGMA user_version = {SNAPSHOT_FORMAT_VERSION}')
+    c.execute('INSERT INTO sync_info VALUES (?, ?, ?, ?)', [
+        cursor, format_sync_cursor(since) if since is not None else None, int(since is not None), int(buildings is not None)])
 
     # Insert company logo file into files table if logo exists
-    if company.logo:
+    if company.logo and (since is None or company.updated_at >= since):
         c.execute(
             'INSERT INTO files (id, name, path, content, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
             [company.logo.file.id if hasattr(company.logo, 'file') and hasattr(company.logo.file, 'id') else company.id,
@@ -158,20 +377,177 @@ def export_project_to_sqlite(company, file_name):
              getattr(company.logo, 'updated_at', None)]
         )
 
-    conn.commit()
-    
-    c.execute('VACUUM')     
+    c.execute('COMMIT')
     conn.close()
 
+    return cursor
+
+
+def get_company_data_version(company):
+    """
+    Compute a version string of the data exported for the company.
+    Any insert, update or delete in the exported tables changes the version.
+    """
+    parts = [str(SNAPSHOT_FORMAT_VERSION)]
+    for table, queryset in _company_querysets(company).items():
+        state = queryset.aggregate(last_update=Max('updated_at'), count=Count('id'))
+        parts.append(f"{table}:{state['count']}:{state['last_update']}")
+    parts.append(f"deleted:{_company_deleted_records(company).aggregate(last_delete=Max('deleted_at'))['last_delete']}")
+
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()[:32]
+
+
+def _read_sync_cursor(file_name):
+    conn = sqlite3.connect(file_name)
+    try:
+        return conn.execute('SELECT cursor FROM sync_info').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _new_temp_name(directory=None, suffix='.tmp'):
+    fd, temp_name = tempfile.mkstemp(dir=directory, suffix=suffix)
+    os.close(fd)
+    os.remove(temp_name)
+    return temp_name
+
+
+def choose_snapshot_encoding(accept_encoding, requested=None):
+    """
+    Pick the compression of a snapshot download.
+    :param accept_encoding: Value of the Accept-Encoding request header.
+    :param requested: Compression explicitly requested by the client ('gzip' or 'none').
+    :return: One of SNAPSHOT_ENCODINGS or None for an uncompressed download.
+    :raises ValueError: if the requested compression is not supported.
+    """
+    if requested:
+        if requested == 'none':
+            return None
+        if requested not in SNAPSHOT_ENCODINGS:
+            raise ValueError(f"Unsupported compression: {requested}")
+        return requested
+
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q=') and quality[2:].strip() in ('0', '0.0', '0.00', '0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+
+    for encoding in SNAPSHOT_ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def _compress_file(source_name, target_name, encoding):
+    with open(source_name, 'rb') as source, open(target_name, 'wb') as target:
+        with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed)
+
+
+def _build_slot():
+    """Cap on the snapshot exports running at once across all workers, so a sync burst cannot starve other requests."""
+    cache_dir = str(settings.SNAPSHOT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    return limited_slots(cache_dir, 'build_slot', settings.SNAPSHOT_MAX_CONCURRENT_BUILDS, timeout=settings.SNAPSHOT_BUILD_WAIT_TIMEOUT)
+
+
+def get_cached_snapshot(company, version=None, encoding=None):
+    """
+    Return the full snapshot of the company from the on-disk cache, building it first if the
+    cached file is missing or belongs to an older data version. Concurrent requests for the
+    same company wait for a single build and share its result.
+    :param encoding: If given, the path of the compressed variant is returned. It is cached
+        next to the raw snapshot, so each data version is compressed only once.
+    :return: A tuple (file_path, cursor, version).
+    :raises TimeoutError: if no build slot became free in time.
+    """
+    if version is None:
+        version = get_company_data_version(company)
+
+    cache_dir = str(settings.SNAPSHOT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = os.path.join(cache_dir, f"company_{company.pk}_")
+
+    def snapshot_names(version):
+        file_name = f"{prefix}{version}.sqlite3"
+        return file_name, f"{file_name}{SNAPSHOT_ENCODING_SUFFIXES[encoding]}" if encoding else None
+
+    file_name, compressed_name = snapshot_names(version)
+    if not os.path.exists(file_name) or (compressed_name and not os.path.exists(compressed_name)):
+        with file_lock(os.path.join(cache_dir, f"company_{company.pk}.lock")):
+            if not os.path.exists(file_name):
+                # The data may have changed since `version` was computed, a build is named after the data it exports
+                version = get_company_data_version(company)
+                file_name, compressed_name = snapshot_names(version)
+
+            # Checked again, the previous holder of the lock has probably built it already
+            if not os.path.exists(file_name):
+                # Build next to the final location and rename, so readers never see a partial file
+                temp_name = _new_temp_name(cache_dir)
+                try:
+                    with _build_slot():
+                        export_project_to_sqlite(company, temp_name)
+                    os.replace(temp_name, file_name)
+                finally:
+                    if os.path.exists(temp_name):
+                        os.remove(temp_name)
+
+                # Drop snapshots (and their compressed variants) of older data versions
+                for old_file in glob.glob(f"{prefix}*"):
+                    if not old_file.startswith(file_name):
+                        try:
+                            os.remove(old_file)
+                        except OSError:
+                            pass  # Removed concurrently by another worker
+
+            if compressed_name and not os.path.exists(compressed_name):
+                temp_name = _new_temp_name(cache_dir)
+                try:
+                    _compress_file(file_name, temp_name, encoding)
+                    os.replace(temp_name, compressed_name)
+                finally:
+                    if os.path.exists(temp_name):
+                        os.remove(temp_name)
+
+    return compressed_name or file_name, _read_sync_cursor(file_name), version
 
-def create_snapshot_file(company):
-    buffer = io.BytesIO()
 
-    with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-        export_project_to_sqlite(company, temp_file.name)
+def create_snapshot_file(company, since=None, version=None, encoding=None, buildings=None):
+    """
+    Build a full, delta (`since`) or partial (`buildings`) snapshot of the company data.
+    Full snapshots are served from the cache kept by `get_cached_snapshot`, the others
+    are written to an anonymous temporary file. Nothing is held in memory, the returned
+    file is meant to be streamed and closed by the response.
+    :param encoding: Compression of the returned file, one of SNAPSHOT_ENCODINGS or None.
+    :return: A tuple (file, cursor, version) with the snapshot opened for binary reading, the data version
+        of a full snapshot may be newer than the given `version`, it is None for the other snapshots.
+    :raises TimeoutError: if no build slot became free in time.
+    """
+    if since is None and buildings is None:
+        file_name, cursor, version = get_cached_snapshot(company, version=version, encoding=encoding)
+        try:
+            return open(file_name, 'rb'), cursor, version
+        except FileNotFoundError:
+            # Removed by a worker that built a newer data version in the meantime, served is the current one
+            file_name, cursor, version = get_cached_snapshot(company, encoding=encoding)
+            return open(file_name, 'rb'), cursor, version
 
-        with open(temp_file.name, 'rb') as f:
-            buffer.write(f.read())
+    file_name = _new_temp_name(suffix='.sqlite3')
+    compressed_name = None
+    try:
+        with _build_slot():
+            cursor = export_project_to_sqlite(company, file_name, since=since, buildings=buildings)
+        if encoding is not None:
+            compressed_name = _new_temp_name()
+            _compress_file(file_name, compressed_name, encoding)
+        snapshot = open(compressed_name or file_name, 'rb')
+    finally:
+        # The open file stays readable until it is closed
+        for temp_name in (file_name, compressed_name):
+            if temp_name and os.path.exists(temp_name):
+                os.remove(temp_name)
 
-    buffer.seek(0)
-    return buffer
\ No newline at end of file
+    return snapshot, cursor, None
@@ -1,14 +1,35 @@
+import contextlib
 import datetime
+import itertools
 import re
 import numpy as np
+import openpyxl
 import pandas as pd
 import logging
 
+from django.db import transaction
+from django.utils import timezone
+
 from ..models import BuildingManager, Building, Firedistinguisher, FiredistinguisherPlacement, FiredistinguisherKind
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Rows written per INSERT/UPDATE statement
+BULK_BATCH_SIZE = 500
+
+# Sheet rows read, cleaned and written at once
+IMPORT_BATCH_SIZE = 5000
+
+# Officer titles the owner's sheet puts in front of the manager's name
+MANAGER_TITLES = ("Správce-náhr.orgán", "Předseda samosprávy", "Předseda SVJ")
+
+# Fields the building manager import writes
+MANAGER_IMPORT_FIELDS = ['address', 'phone', 'phone2', 'email']
+BUILDING_IMPORT_FIELDS = ['address', 'city', 'zipcode', 'note', 'company', 'owner', 'manager']
+# Fields the fire extinguisher import writes
+FIREDISTINGUISHER_IMPORT_FIELDS = ['kind', 'size', 'power', 'manufacturer', 'eliminated', 'manufactured_year', 'next_inspection']
+
 def parse_address(address):
     adress_split = address.split(',')
     if len(adress_split) < 2:
@@ -24,250 +45,586 @@ def parse_address(address):
     return address.strip(), city, zipcode
 
 
-def process_building_manager_row(row, owner, company):
-    if row is None or "Dům" not in row or pd.isna(row["Dům"]):
-        return 0
+def parse_addresses(addresses):
+    """
+    `parse_address` of a whole column at once.
+    :param addresses: Series of address strings.
+    :return: Tuple of lists (addresses, cities, zipcodes).
+    """
+    street, separator, zip_code_city = addresses.str.rpartition(',').T.values
+    # Without a comma rpartition puts the whole text last
+    has_city = separator == ','
+    street = np.where(has_city, street, zip_code_city)
+    zip_code_city = np.where(has_city, zip_code_city, '')
+
+    zip_code_city = pd.Series(zip_code_city, index=addresses.index)
+    zipcodes = zip_code_city.str.extract(r'^([\s\d]*)', expand=False).str.strip()
+    cities = [text.replace(zipcode, '').strip() for text, zipcode in zip(zip_code_city, zipcodes)]
+
+    return pd.Series(street).str.strip().tolist(), cities, zipcodes.tolist()
+
+
+def _strip_float_suffix(texts):
+    # A sheet exported from a float column writes the ID 12 as `12.0`
+    return texts.str.replace(r'^(\d+)\.0+$', r'\1', regex=True)
+
+
+def normalize_building_ids(building_ids):
+    """
+    Building IDs as strings. Spreadsheets hold numeric IDs as floats, which lose the `.0`.
+    """
+    if pd.api.types.is_float_dtype(building_ids):
+        return building_ids.astype('int64').astype(str).tolist()
+    if pd.api.types.is_integer_dtype(building_ids):
+        return building_ids.astype(str).tolist()
+
+    is_float = building_ids.map(type).isin((float, np.float64))
+    normalized = _strip_float_suffix(building_ids.astype(str).str.strip())
+    normalized[is_float] = building_ids[is_float].astype('int64').astype(str)
+    return normalized.tolist()
+
+
+def _optional_values(column):
+    """Values of a column with None for the missing ones."""
+    return column.astype(object).where(column.notna(), None).tolist()
+
+
+def _import_values(obj, fields):
+    # Compared as the database stores them, e.g. a phone read as a number is saved as text
+    return tuple(obj._meta.get_field(field).get_prep_value(getattr(obj, obj._meta.get_field(field).attname)) for field in fields)
+
+
+def _changed_objects(objs, original_values, fields):
+    """
+    The imported objects whose fields differ from the prefetched values.
+    """
+    changed = []
+    for obj in objs:
+        values = _import_values(obj, fields)
+        if values != original_values[obj.pk]:
+            # Later batches compare to what is in the database now
+            original_values[obj.pk] = values
+            changed.append(obj)
+    return changed
+
+
+def _bulk_update_changed(model, objs, original_values, fields):
+    """
+    Write the imported objects whose fields differ from the prefetched values,
+    so re-importing the same sheet neither rewrites rows nor bumps their sync timestamps.
+    :return: The number of written objects.
+    """
+    changed = _changed_objects(objs, original_values, fields)
+
+    # bulk_update does not set auto_now fields, the mobile sync relies on them
+    now = timezone.now()
+    for obj in changed:
+        obj.updated_at = now
+    model.objects.bulk_update(changed, [*fields, 'updated_at'], batch_size=BULK_BATCH_SIZE)
+    return len(changed)
+
+
+def _bulk_create_imported(model, objs, original_values, fields):
+    """Create the new objects of a batch, later batches compare their changes to the values written now."""
+    model.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+    original_values.update((obj.pk, _import_values(obj, fields)) for obj in objs)
+
+
+def _normalize_blanks(df):
+    # Empty cells are NaN as in a whole-file read, whatever the other cells of their column hold
+    return df.mask(df.isna() | df.eq(''))
+
+
+def _csv_batches(file, columns, batch_size):
+    # Read as text, inferred per chunk a column of digits and blanks would turn into floats, e.g. serial numbers `12346.0`
+    with pd.read_csv(file, usecols=columns, chunksize=batch_size, dtype=str) as reader:
+        for df in reader:
+            yield _normalize_blanks(df)
+
+
+def _xlsx_batches(file, header, columns, batch_size):
+    # Read-only mode streams the rows of the sheet instead of loading the whole workbook
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(min_row=2, values_only=True)
+        indexes = [header.index(column) for column in columns]
+        start = 0
+        while batch := [[row[i] if i < len(row) else None for i in indexes] for row in itertools.islice(rows, batch_size)]:
+            # Numbered across batches like the CSV chunks, the index locates a row in the sheet
+            # Cells keep the types openpyxl reads, inferred per batch an integer column with blanks would turn into floats
+            yield _normalize_blanks(pd.DataFrame(batch, columns=columns, index=range(start, start + len(batch)), dtype=object))
+            start += len(batch)
+    finally:
+        workbook.close()
+
+
+def _count_csv_rows(file):
+    # Lines, not rows, a quoted value may span lines, good enough to report progress
+    num_lines = sum(chunk.count(b'\n') for chunk in file.chunks())
+    file.seek(0)
+    return max(num_lines - 1, 0)
+
+
+def read_sheet(file, columns, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Stream the rows of an uploaded CSV or XLSX sheet (its first sheet) in DataFrames of `batch_size` rows,
+    holding only the requested columns, so memory use does not grow with the file.
+    :return: Tuple (all column names of the header, generator of DataFrames, estimated number of rows or None).
+    :raises ValueError: if the file is neither CSV nor XLSX.
+    """
+    if file.name.endswith('.csv'):
+        header = [str(column) for column in pd.read_csv(file, nrows=0).columns]
+        file.seek(0)
+        available = [column for column in header if column in columns]
+        return header, _csv_batches(file, available, batch_size), _count_csv_rows(file)
 
-    building_id = row["Dům"]
-    if type(building_id) is float or type(building_id) is np.float64:
-        building_id = str(int(building_id))
-    else:
-        building_id = str(building_id).strip()
-
-    out = 0
-
-    # Process the row and create a BuildingManager instance
-    person_name = str(row["Funkcionář"])\
-        .replace("Správce-náhr.orgán", "")\
-        .replace("Předseda samosprávy", "")\
-        .replace("Předseda SVJ", "")\
-        .strip()
-
-    building_manager = BuildingManager.objects.filter(name=person_name).first()
-    if building_manager is None:
-        building_manager = BuildingManager(
-            name=person_name,
-            address=row["Adresa"],
-            phone=row["Telefon"],
-            email=row["Email"]
-        )
-        building_manager.save()
-        out += 1
-    else:
-        building_manager.address = row["Adresa"]
-        building_manager.phone = row["Telefon"]
-        building_manager.email = row["Email"]
-        if "Telefon2" in row and not pd.isna(row["Telefon2"]):
-            building_manager.phone2 = row["Telefon2"]
-        building_manager.save()
-    
-
-    address, city, zipcode = parse_address(row["Adresa"])
-
-    # Process the row and create a Building instance
-
-    building = Building.objects.filter(building_id=building_id, company=company).first()
-    if building is not None:
-        # Update existing building
-        building.address = address
-        building.city = city
-        building.zipcode = zipcode
-        building.note = "Imported from file"
-        building.company = company
-        building.owner = owner
-        building.manager = building_manager
-        building.save()
-    else:
-        building = Building(
-            building_id=building_id,
-            address=address,
-            city=city,
-            zipcode=zipcode,
-            note="Imported from file",
-            company=company,
-            owner=owner,
-            manager=building_manager
-        )
-        building.save()
-        out += 1
+    if file.name.endswith('.xlsx'):
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            worksheet = workbook.worksheets[0]
+            first_row = next(worksheet.iter_rows(max_row=1, values_only=True), ())
+            # Taken from the sheet's dimension record, which not every writer fills in
+            num_rows = worksheet.max_row - 1 if worksheet.max_row else None
+        finally:
+            workbook.close()
+        file.seek(0)
+        header = [str(column) if column is not None else '' for column in first_row]
+        available = [column for column in header if column in columns]
+        return header, _xlsx_batches(file, header, available, batch_size), num_rows
+
+    raise ValueError("Unsupported file format. Please upload a CSV or Excel file.")
+
+
+def _sheet_row_numbers(index):
+    # The header is the first row of the sheet
+    return (index + 2).tolist()
+
+
+def _read_import_sheet(file, import_class):
+    """
+    :return: Tuple (generator of DataFrames, estimated number of rows, error message or None).
+    """
+    try:
+        header, batches, num_rows = read_sheet(file, import_class.required_columns)
+    except ValueError as e:
+        return None, None, str(e)
+
+    missing = import_class.required_columns - set(header)
+    if missing:
+        batches.close()
+        logger.error(f"Missing required columns: {missing}")
+        return None, None, "Invalid file format. Required columns are missing. Missing columns: " + ", ".join(missing)
+    return batches, num_rows, None
+
+
+def _import_sheet(file, import_class, owner, company, progress=None):
+    """
+    Feed the batches of an uploaded sheet to an import, all of them written in one transaction.
+    With `progress` each batch is committed on its own instead, so the reported counts are visible
+    to the status page and a failure keeps the batches imported before it.
+    :param progress: Optional callable receiving the completed percentage and the import `stats` after each batch.
+    :return: Tuple (number of imported records, error message or None).
+    """
+    batches, num_rows, error_message = _read_import_sheet(file, import_class)
+    if error_message:
+        return 0, error_message
+
+    # Closed right away when an import fails, not once the file it reads is already closed
+    with contextlib.closing(batches):
+        if progress is None:
+            with transaction.atomic():
+                sheet_import = import_class(owner, company)
+                for df in batches:
+                    sheet_import.import_batch(df)
+            return sheet_import.stats["created"], None
+
+        sheet_import = import_class(owner, company)
+        for df in batches:
+            with transaction.atomic():
+                sheet_import.import_batch(df)
+            progress(min(99, sheet_import.stats["rows"] * 100 // num_rows) if num_rows else 0, sheet_import.stats)
+    return sheet_import.stats["created"], None
+
+
+def _preview_sheet(file, import_class, owner, company, progress=None):
+    """
+    Compare an uploaded sheet with the database without writing anything.
+    :param progress: Optional callable receiving the completed percentage and the import `stats` after each batch.
+    :return: Tuple (the import `stats` and `diff`, error message or None).
+    """
+    batches, num_rows, error_message = _read_import_sheet(file, import_class)
+    if error_message:
+        return None, error_message
+
+    with contextlib.closing(batches):
+        sheet_import = import_class(owner, company, dry_run=True)
+        for df in batches:
+            sheet_import.import_batch(df)
+            if progress is not None:
+                progress(min(99, sheet_import.stats["rows"] * 100 // num_rows) if num_rows else 0, sheet_import.stats)
+    # A record repeated in the sheet is listed once, in the order it first changes
+    diff = {key: list(dict.fromkeys(items)) for key, items in sheet_import.diff.items()}
+    return {**sheet_import.stats, **diff}, None
+
+
+class _BuildingManagerImport:
+    """
+    Buildings and their managers from the owner's sheet, imported batch by batch.
+    Managers (matched by name, the oldest one wins) and the company's buildings are kept in maps across batches,
+    the rows are applied in order, so a manager or building repeated in the file ends up with its last row.
+    With `dry_run` nothing is written, `diff` collects what the import would change instead.
+    """
+    required_columns = {'Dům', 'Adresa', 'Funkcionář', 'Adresa funkcionáře', "Telefon", 'Telefon2', 'Email'}
 
-    return out
+    def __init__(self, owner, company, dry_run=False):
+        self.owner = owner
+        self.company = company
+        self.dry_run = dry_run
+        self.managers = {}
+        self.buildings = {}
+        for building in Building.objects.filter(company=company).order_by('-pk'):
+            self.buildings[building.building_id] = building
+        self.original_managers = {}
+        self.original_buildings = {obj.pk: _import_values(obj, BUILDING_IMPORT_FIELDS) for obj in self.buildings.values()}
+        # Rows read, records created and updated, rows without a building ID
+        self.stats = {"rows": 0, "created": 0, "updated": 0, "failed": 0}
+        # Building IDs, manager names and sheet row numbers
+        self.diff = {"new_buildings": [], "changed_buildings": [], "new_managers": [], "changed_managers": [], "invalid_rows": []}
+
+    def _prefetch_managers(self, person_names):
+        unknown = set(person_names) - self.managers.keys()
+        if not unknown:
+            return
+        for building_manager in BuildingManager.objects.filter(name__in=unknown).order_by('-pk'):
+            self.managers[building_manager.name] = building_manager
+        self.original_managers.update((obj.pk, _import_values(obj, MANAGER_IMPORT_FIELDS)) for obj in self.managers.values() if obj.name in unknown)
+
+    def import_batch(self, df):
+        """
+        Import the rows of a DataFrame, written right away, and add them to `stats`.
+        :return: The number of created managers and buildings.
+        """
+        num_rows = len(df)
+        invalid = df["Dům"].isna()
+        if self.dry_run:
+            self.diff["invalid_rows"] += _sheet_row_numbers(df.index[invalid])
+        df = df[~invalid]
+        self.stats["rows"] += num_rows
+        self.stats["failed"] += num_rows - len(df)
+        if df.empty:
+            return 0
+
+        # Clean whole columns at once
+        building_ids = normalize_building_ids(df["Dům"])
+        person_names = df["Funkcionář"].astype(str)
+        for title in MANAGER_TITLES:
+            person_names = person_names.str.replace(title, "", regex=False)
+        person_names = person_names.str.strip().tolist()
+        addresses, cities, zipcodes = parse_addresses(df["Adresa"].astype(str))
+        self._prefetch_managers(person_names)
+
+        out = 0
+        new_managers = []
+        changed_managers = {}
+        new_buildings = []
+        changed_buildings = {}
+        rows = zip(
+            building_ids, person_names, addresses, cities, zipcodes,
+            df["Adresa"].tolist(), df["Telefon"].tolist(), _optional_values(df["Telefon2"]), df["Email"].tolist(),
+        )
+        for building_id, person_name, address, city, zipcode, manager_address, phone, phone2, email in rows:
+            building_manager = self.managers.get(person_name)
+            if building_manager is None:
+                building_manager = BuildingManager(
+                    name=person_name,
+                    address=manager_address,
+                    phone=phone,
+                    email=email
+                )
+                self.managers[person_name] = building_manager
+                new_managers.append(building_manager)
+                out += 1
+            else:
+                building_manager.address = manager_address
+                building_manager.phone = phone
+                building_manager.email = email
+                if phone2 is not None:
+                    building_manager.phone2 = phone2
+                if building_manager.pk:
+                    changed_managers[building_manager.pk] = building_manager
+
+            building = self.buildings.get(building_id)
+            if building is not None:
+                # Update existing building
+                building.address = address
+                building.city = city
+                building.zipcode = zipcode
+                building.note = "Imported from file"
+                building.company = self.company
+                building.owner = self.owner
+                building.manager = building_manager
+                if building.pk:
+                    changed_buildings[building.pk] = building
+            else:
+                building = Building(
+                    building_id=building_id,
+                    address=address,
+                    city=city,
+                    zipcode=zipcode,
+                    note="Imported from file",
+                    company=self.company,
+                    owner=self.owner,
+                    manager=building_manager
+                )
+                self.buildings[building_id] = building
+                new_buildings.append(building)
+                out += 1
+
+        if self.dry_run:
+            # New objects stay in the maps without a primary key, later rows of them are compared in memory
+            changed_managers = _changed_objects(changed_managers.values(), self.original_managers, MANAGER_IMPORT_FIELDS)
+            changed_buildings = _changed_objects(changed_buildings.values(), self.original_buildings, BUILDING_IMPORT_FIELDS)
+            self.diff["new_managers"] += [obj.name for obj in new_managers]
+            self.diff["changed_managers"] += [obj.name for obj in changed_managers]
+            self.diff["new_buildings"] += [obj.building_id for obj in new_buildings]
+            self.diff["changed_buildings"] += [obj.building_id for obj in changed_buildings]
+            num_updated = len(changed_managers) + len(changed_buildings)
+        else:
+            _bulk_create_imported(BuildingManager, new_managers, self.original_managers, MANAGER_IMPORT_FIELDS)
+            num_updated = _bulk_update_changed(BuildingManager, changed_managers.values(), self.original_managers, MANAGER_IMPORT_FIELDS)
+            _bulk_create_imported(Building, new_buildings, self.original_buildings, BUILDING_IMPORT_FIELDS)
+            num_updated += _bulk_update_changed(Building, changed_buildings.values(), self.original_buildings, BUILDING_IMPORT_FIELDS)
+        self.stats["created"] += out
+        self.stats["updated"] += num_updated
+        return out
 
 
-def import_building_manager_data(file, owner, company):
+def import_building_manager_data(file, owner, company, progress=None):
     # Logic to import building manager data from the uploaded file
     # return number of imported records and error message
-    if file.name.endswith('.csv'):
-        # Process CSV file
-        df = pd.read_csv(file)
-    elif file.name.endswith('.xlsx'):
-        # Process Excel file
-        df = pd.read_excel(file)
-    else:
-        return 0, "Unsupported file format. Please upload a CSV or Excel file."
+    return _import_sheet(file, _BuildingManagerImport, owner, company, progress=progress)
 
 
-    required_columns = {'Dům', 'Adresa', 'Funkcionář', 'Adresa funkcionáře', "Telefon", 'Telefon2', 'Email'}
-    if not required_columns.issubset(df.columns):
-        return 0, "Invalid file format. Required columns are missing. Required columns: " + ", ".join(required_columns)
-
-    out = 0
-    for idx in df.index:
-        out += process_building_manager_row(df.loc[idx], owner, company)
-
-    return out, None  # Example return, replace with actual logic
+def preview_building_manager_data(file, owner, company, progress=None):
+    # Changes the import of the uploaded file would make, nothing is written
+    # return the counts and changed records, and error message
+    return _preview_sheet(file, _BuildingManagerImport, owner, company, progress=progress)
 
 
+def _eliminated(df):
+    """Whether each extinguisher is out of service: it has a removal date or is marked as not operational."""
+    removed = df["Vyřazen"].notna() & (df["Vyřazen"].astype(str) != '')
+    not_operational = df["Provozuschopný"].notna() & (df["Provozuschopný"].astype(str).str.lower() == 'ne')
+    return (removed | not_operational).tolist()
 
-def _eliminated(row):
-    if "Vyřazen" in row and row["Vyřazen"] is not np.nan and str(row["Vyřazen"]) != '':
-        return True
-    if "Provozuschopný" in row and row["Provozuschopný"] is not np.nan and str(row["Provozuschopný"]).lower() == 'ne':
-        return True
-    return False
 
-
-def _next_inspection(row):
-    if "Příští per. zkouška" in row and row["Příští per. zkouška"] is not np.nan and str(row["Příští per. zkouška"]) != '':
-        if type(row["Příští per. zkouška"]) is datetime.datetime:
-            return row["Příští per. zkouška"].date()
-        else:
-            try:
-                return pd.to_datetime(str(row["Příští per. zkouška"]), format='%Y/%m').date()
-            except Exception as e:
-                logger.error(f"Error parsing next inspection date: {e}")
-                return None
-    return None
-
-
-
-def _get_kind_and_size(text: str):
-    text = text.strip().lower()
-    kind = FiredistinguisherKind.OTHER
-    size = None
-
-    kind_char = text[0]
-    if kind_char == 's':
-        kind = FiredistinguisherKind.SNOW
-    elif kind_char == 'p':
-        kind = FiredistinguisherKind.POWDER
-    elif kind_char == 'v' or kind_char == 'w':
-        kind = FiredistinguisherKind.WATER
-    elif kind_char == 'f' or kind_char == 'p':
-        kind = FiredistinguisherKind.FOAM
+def _next_inspection(column):
+    """Dates of the next periodic test, given as a date cell or as `YYYY/MM` text."""
+    if pd.api.types.is_datetime64_any_dtype(column):
+        dates = column
     else:
-        kind = FiredistinguisherKind.OTHER
-        
-    if len(text) > 1:
-        size_text = text[1:].strip()
-        try:
-            size = float(size_text.replace(',', '.'))
-        except ValueError:
-            size = None
-
-    return kind, size
-
-
-
-def process_firedistinguisher_row(row, owner, company):
-    if row is None or "Výrobní číslo" not in row or pd.isna(row["Výrobní číslo"]):
-        return 0
-
-    serial_number = str(row["Výrobní číslo"]).strip()
-
-    if '/' in serial_number and len(serial_number) > 3:
+        is_date = column.map(lambda value: isinstance(value, datetime.date))
+        dates = pd.to_datetime(column.where(~is_date).astype(str), format='%Y/%m', errors='coerce')
+        dates[is_date] = pd.to_datetime(column[is_date])
+
+        invalid = column.notna() & (column.astype(str) != '') & dates.isna()
+        if invalid.any():
+            logger.error(f"Error parsing next inspection date of {invalid.sum()} rows, e.g. {column[invalid].iloc[0]!r}")
+
+    return [date.date() if not pd.isna(date) else None for date in dates]
+
+
+# Extinguisher kinds by the first letter of the `Druh` column
+KIND_BY_LETTER = {
+    's': FiredistinguisherKind.SNOW,
+    'p': FiredistinguisherKind.POWDER,
+    'v': FiredistinguisherKind.WATER,
+    'w': FiredistinguisherKind.WATER,
+    'f': FiredistinguisherKind.FOAM,
+}
+
+
+def _get_kind_and_size(column):
+    """
+    Kinds and sizes of the extinguishers from texts like `P6` or `V 9,5`.
+    :return: Tuple of lists (kinds, sizes).
+    """
+    text = column.astype(str).str.strip().str.lower()
+    kinds = text.str[0].map(KIND_BY_LETTER).fillna(FiredistinguisherKind.OTHER)
+    sizes = pd.to_numeric(text.str[1:].str.strip().str.replace(',', '.', regex=False), errors='coerce')
+    return kinds.tolist(), _optional_values(sizes)
+
+
+def _manufactured_year(serial_numbers):
+    """Years of manufacture, the two digits after the first `/` of a serial number like `123/19`."""
+    year_text = serial_numbers.str.extract(r'^[^/]*/(.{0,2})', expand=False)
+    valid = (serial_numbers.str.len() > 3) & year_text.str.fullmatch(r'\s*[+-]?\d+\s*').fillna(False).astype(bool)
+    years = pd.to_numeric(year_text.where(valid), errors='coerce')
+    years = years + np.where(years < 50, 2000, 1900)
+    return [int(year) if not pd.isna(year) else None for year in years]
+
+
+def _placement_building_id(column):
+    """IDs of the buildings the extinguishers are placed in, numbers read from a spreadsheet lose their `.0`."""
+    is_number = column.map(type).isin((float, np.float64, np.int64, int))
+    numbers = pd.to_numeric(column[is_number], errors='coerce')
+    if numbers.isna().any():
+        logger.error(f"Invalid building ID in {numbers.isna().sum()} rows")
+
+    building_ids = column.astype(object).where(~is_number, None)
+    is_text = column.map(type) == str
+    building_ids[is_text] = _strip_float_suffix(column[is_text].str.strip())
+    valid = numbers.notna()
+    building_ids[valid[valid].index] = numbers[valid].astype('int64').astype(str)
+    return building_ids.tolist()
+
+
+def _latest_placements(company):
+    """The ID of the building each extinguisher of the company is currently placed in."""
+    latest = {}
+    placements = (
+        FiredistinguisherPlacement.objects
+        .filter(firedistinguisher__managed_by=company)
+        .order_by('created_at', 'id')
+        .values_list('firedistinguisher_id', 'building_id')
+        .iterator(chunk_size=BULK_BATCH_SIZE * 4)
+    )
+    for firedistinguisher_id, building_id in placements:
+        latest[firedistinguisher_id] = building_id
+    return latest
+
+
+class _FiredistinguisherImport:
+    """
+    Fire extinguishers from the owner's sheet and their placements, imported batch by batch.
+    The company's extinguishers (the oldest one per serial number wins), the owner's buildings and where
+    each extinguisher is placed now are kept in maps across batches, the rows are applied in order,
+    so an extinguisher repeated in the file ends up with its last row.
+    With `dry_run` nothing is written, `diff` collects what the import would change instead.
+    """
+    required_columns = {'Samospráva', 'Umístění', 'Druh', 'Typ', 'Výrobce', 'Výrobní číslo', 'Tlaková zkouška', 'Oprava', 'Vyřazen', 'Provozuschopný', 'Příští per. zkouška'}
 
-        manufactured_year = serial_number[serial_number.find('/')+1:serial_number.find('/')+3]
-        try:
-            manufactured_year = int(manufactured_year)
-            if manufactured_year < 50:
-                manufactured_year += 2000
+    def __init__(self, owner, company, dry_run=False):
+        self.owner = owner
+        self.company = company
+        self.dry_run = dry_run
+        self.firedistinguishers = {}
+        for firedistinguisher in Firedistinguisher.objects.filter(managed_by=company).order_by('-pk'):
+            self.firedistinguishers[firedistinguisher.serial_number] = firedistinguisher
+        self.buildings = {}
+        for building in Building.objects.filter(company=company, owner=owner).order_by('-pk'):
+            self.buildings[building.building_id] = building
+        latest_placements = _latest_placements(company)
+        self.original_firedistinguishers = {obj.pk: _import_values(obj, FIREDISTINGUISHER_IMPORT_FIELDS) for obj in self.firedistinguishers.values()}
+        # Keyed by id() since extinguishers created by this import have no primary key until their batch is written
+        self.current_buildings = {id(obj): latest_placements.get(obj.pk) for obj in self.firedistinguishers.values()}
+        # Rows read, records created and updated, rows without a serial number
+        self.stats = {"rows": 0, "created": 0, "updated": 0, "failed": 0}
+        # Serial numbers, (serial number, building ID) pairs of placements changed on existing extinguishers,
+        # serial numbers of rows whose building is not one of the owner's, and sheet row numbers
+        self.diff = {"new_firedistinguishers": [], "changed_firedistinguishers": [], "moved_firedistinguishers": [], "unplaced_firedistinguishers": [], "invalid_rows": []}
+
+    def import_batch(self, df):
+        """
+        Import the rows of a DataFrame, written right away, and add them to `stats`.
+        :return: The number of created extinguishers and placements.
+        """
+        num_rows = len(df)
+        invalid = df["Výrobní číslo"].isna()
+        if self.dry_run:
+            self.diff["invalid_rows"] += _sheet_row_numbers(df.index[invalid])
+        df = df[~invalid]
+        self.stats["rows"] += num_rows
+        self.stats["failed"] += num_rows - len(df)
+        if df.empty:
+            return 0
+
+        # Clean whole columns at once
+        serial_numbers = df["Výrobní číslo"].astype(str).str.strip()
+        manufactured_years = _manufactured_year(serial_numbers)
+        kinds, sizes = _get_kind_and_size(df["Druh"])
+        eliminated = _eliminated(df)
+        next_inspections = _next_inspection(df["Příští per. zkouška"])
+        building_ids = _placement_building_id(df["Samospráva"])
+
+        out = 0
+        new_firedistinguishers = []
+        changed_firedistinguishers = {}
+        new_placements = []
+        rows = zip(
+            serial_numbers, manufactured_years, kinds, sizes, eliminated, next_inspections, building_ids,
+            df["Typ"].tolist(), df["Výrobce"].tolist(), df["Umístění"].tolist(),
+        )
+        for serial_number, manufactured_year, kind, size, is_eliminated, next_inspection, building_id, power, manufacturer, description in rows:
+            firedistinguisher = self.firedistinguishers.get(serial_number)
+            if firedistinguisher is None:
+                firedistinguisher = Firedistinguisher(
+                    kind=kind,
+                    size=size,
+                    power=power,
+                    manufacturer=manufacturer,
+                    serial_number=serial_number,
+                    eliminated=is_eliminated,
+                    manufactured_year=manufactured_year,
+                    managed_by=self.company,
+                    next_inspection=next_inspection
+                )
+                self.firedistinguishers[serial_number] = firedistinguisher
+                self.current_buildings[id(firedistinguisher)] = None
+                new_firedistinguishers.append(firedistinguisher)
+                out += 1
             else:
-                manufactured_year += 1900
-        except ValueError:
-            manufactured_year = None
-    else:
-        manufactured_year = None
-
-    out = 0
-
-    # Process the row and create a Firedistinguisher instance
-    firedistinguisher = Firedistinguisher.objects.filter(serial_number=serial_number, managed_by=company).first()
-    kind, size = _get_kind_and_size(str(row["Druh"]))
-
-
+                firedistinguisher.kind = kind
+                firedistinguisher.size = size
+                firedistinguisher.power = power
+                firedistinguisher.manufacturer = manufacturer
+                firedistinguisher.eliminated = is_eliminated
+                firedistinguisher.manufactured_year = manufactured_year
+                firedistinguisher.next_inspection = next_inspection
+                if firedistinguisher.pk:
+                    changed_firedistinguishers[firedistinguisher.pk] = firedistinguisher
+
+            building = self.buildings.get(building_id)
+            if building is not None:
+                if self.current_buildings[id(firedistinguisher)] == building.pk:
+                    continue  # No change in placement
+
+                # Create new placement
+                new_placements.append(FiredistinguisherPlacement(
+                    description=description,
+                    firedistinguisher=firedistinguisher,
+                    building=building
+                ))
+                self.current_buildings[id(firedistinguisher)] = building.pk
+                out += 1
+            elif self.dry_run:
+                self.diff["unplaced_firedistinguishers"].append(serial_number)
+
+        if self.dry_run:
+            changed_firedistinguishers = _changed_objects(changed_firedistinguishers.values(), self.original_firedistinguishers, FIREDISTINGUISHER_IMPORT_FIELDS)
+            self.diff["new_firedistinguishers"] += [obj.serial_number for obj in new_firedistinguishers]
+            self.diff["changed_firedistinguishers"] += [obj.serial_number for obj in changed_firedistinguishers]
+            self.diff["moved_firedistinguishers"] += [
+                (placement.firedistinguisher.serial_number, placement.building.building_id)
+                for placement in new_placements if placement.firedistinguisher.pk
+            ]
+            num_updated = len(changed_firedistinguishers)
+        else:
+            _bulk_create_imported(Firedistinguisher, new_firedistinguishers, self.original_firedistinguishers, FIREDISTINGUISHER_IMPORT_FIELDS)
+            num_updated = _bulk_update_changed(Firedistinguisher, changed_firedistinguishers.values(), self.original_firedistinguishers, FIREDISTINGUISHER_IMPORT_FIELDS)
+            FiredistinguisherPlacement.objects.bulk_create(new_placements, batch_size=BULK_BATCH_SIZE)
+        self.stats["created"] += out
+        self.stats["updated"] += num_updated
+        return out
 
-    if firedistinguisher is None:
-        firedistinguisher = Firedistinguisher(
-            kind=kind,
-            size=size,
-            power=row["Typ"],
-            manufacturer=row["Výrobce"],
-            serial_number=serial_number,
-            eliminated=_eliminated(row),
-            manufactured_year=manufactured_year,
-            managed_by=company,
-            next_inspection=_next_inspection(row)
-        )
-        firedistinguisher.save()
-        out += 1
-    else:
-        firedistinguisher.kind = kind
-        firedistinguisher.size = size
-        firedistinguisher.power = row["Typ"]
-        firedistinguisher.manufacturer = row["Výrobce"]
-        firedistinguisher.eliminated = _eliminated(row)
-        firedistinguisher.manufactured_year = manufactured_year
-        firedistinguisher.next_inspection = _next_inspection(row)
-        firedistinguisher.save()
-
-    building_id = row["Samospráva"]
-    if type(building_id) in [float, np.float64, np.int64, int]:
-        try:
-            building_id = str(int(building_id))
-        except ValueError:
-            logger.error(f"Invalid building ID: {building_id}")
-            building_id = None
-
-    building = Building.objects.filter(building_id=building_id, company=company, owner=owner).first()
-
-    if building is not None:
-        if firedistinguisher.get_current_placement() is not None and firedistinguisher.get_current_placement().building == building:
-            return out  # No change in placement
-        
-        # Create new placement
-        placement = FiredistinguisherPlacement(
-            description=row["Umístění"],
-            firedistinguisher=firedistinguisher,
-            building=building
-        )
-        placement.save()
-        out += 1
-    
-    return out
 
-    
-def import_firedistinguisher_data(file, owner, company):
+def import_firedistinguisher_data(file, owner, company, progress=None):
     # Logic to import fire distinguisher data from the uploaded file
     # return number of imported records and error message
-    if file.name.endswith('.csv'):
-        # Process CSV file
-        df = pd.read_csv(file)
-    elif file.name.endswith('.xlsx'):
-        # Process Excel file
-        df = pd.read_excel(file)
-    else:
-        return 0, "Unsupported file format. Please upload a CSV or Excel file."
-
-    required_columns = {'Samospráva', 'Umístění', 'Druh', 'Typ', 'Výrobce', 'Výrobní číslo', 'Tlaková zkouška', 'Oprava', 'Vyřazen', 'Provozuschopný', 'Příští per. zkouška'}
-
-    if not required_columns.issubset(df.columns):
-        missing = required_columns - set(df.columns)
-        logger.error(f"Missing required columns: {missing}")
-        return 0, "Invalid file format. Required columns are missing. Missing columns: " + ", ".join(missing)
+    return _import_sheet(file, _FiredistinguisherImport, owner, company, progress=progress)
 
-    out = 0
-    for idx in df.index:
-        out += process_firedistinguisher_row(df.loc[idx], owner, company)
 
-    return out, None  # Example return, replace with actual logic
+def preview_firedistinguisher_data(file, owner, company, progress=None):
+    # Changes the import of the uploaded file would make, nothing is written
+    # return the counts and changed records, and error message
+    return _preview_sheet(file, _FiredistinguisherImport, owner, company, progress=progress)
@@ -0,0 +1,318 @@
+import datetime
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.core.files import File
+from django.db import DatabaseError, connection
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from ..models import BackgroundJob, BackgroundJobKind, BackgroundJobStatus, BuildingOwner, FaultPhoto
+from .add_inspection import SpooledFile, add_inspection, add_inspection_batch
+from .photos import PhotoProcessingError, make_renditions
+
+
+logger = logging.getLogger(__name__)
+
+# Queued jobs a worker tries to claim before it gives up for one poll
+CLAIM_CANDIDATES = 10
+
+# Sheet imports and their previews started from the tools page
+IMPORT_PREVIEW_JOB_KINDS = (BackgroundJobKind.BUILDING_MANAGER_PREVIEW, BackgroundJobKind.FIREDISTINGUISHER_PREVIEW)
+IMPORT_JOB_KINDS = (BackgroundJobKind.BUILDING_MANAGER_IMPORT, BackgroundJobKind.FIREDISTINGUISHER_IMPORT, *IMPORT_PREVIEW_JOB_KINDS)
+
+# Records a preview job keeps for each kind of change, the others are only counted
+IMPORT_PREVIEW_SHOWN = 50
+
+
+def enqueue_job(kind, company, user, input_file=None, parameters=None):
+    """
+    Store a new job for the `run_jobs` worker.
+    :param input_file: Optional (uploaded) file the job processes, kept in the storage until the job finishes.
+    :param parameters: Optional JSON serializable dict of the job's options, e.g. the selected owner of an import.
+    """
+    job = BackgroundJob(kind=kind, company=company, created_by=user, input_file=input_file, parameters=parameters or {})
+    job.save()
+    return job
+
+
+def enqueue_photo_processing(company, user):
+    """
+    Queue a job creating the renditions of the company's new fault photos,
+    unless one is already queued or there is nothing to process.
+    :return: The queued job or None.
+    """
+    if BackgroundJob.objects.filter(kind=BackgroundJobKind.PHOTO_PROCESSING, company=company, status=BackgroundJobStatus.QUEUED).exists():
+        return None
+    if not FaultPhoto.objects.filter(fault_inspection__inspection__building__company=company, renditions_ready=False).exists():
+        return None
+    return enqueue_job(BackgroundJobKind.PHOTO_PROCESSING, company, user)
+
+
+def set_job_progress(job, progress, result=None):
+    """
+    Report the completed percentage of a running job. Must not be called inside a transaction,
+    the status endpoint would not see the value until it commits.
+    :param result: Optional partial result shown while the job runs, replaced by the final one.
+    """
+    job.progress = progress
+    # Reported progress doubles as a heartbeat
+    values = {'progress': progress, 'heartbeat_at': timezone.now()}
+    if result is not None:
+        job.result = values['result'] = result
+    _claimed(job).update(**values)
+
+
+def _claimed(job):
+    # A job queued again and claimed by another worker gets a new `started_at`, it identifies this worker's claim
+    return BackgroundJob.objects.filter(pk=job.pk, status=BackgroundJobStatus.RUNNING, started_at=job.started_at)
+
+
+def claim_next_job(kinds=None):
+    """
+    Mark the oldest queued job as running and return it, None if the queue is empty.
+    The conditional update makes sure only one worker claims a job.
+    """
+    queued = BackgroundJob.objects.filter(status=BackgroundJobStatus.QUEUED)
+    if kinds:
+        queued = queued.filter(kind__in=kinds)
+
+    for job_id in queued.order_by('created_at', 'id').values_list('id', flat=True)[:CLAIM_CANDIDATES]:
+        now = timezone.now()
+        claimed = BackgroundJob.objects.filter(pk=job_id, status=BackgroundJobStatus.QUEUED).update(
+            status=BackgroundJobStatus.RUNNING,
+            started_at=now,
+            heartbeat_at=now,
+            progress=0,
+        )
+        if claimed:
+            return BackgroundJob.objects.get(pk=job_id)
+    return None
+
+
+def requeue_stale_jobs():
+    """
+    Queue again jobs whose worker died while running them, recognized by a missing heartbeat.
+    :return: The number of queued jobs.
+    """
+    stale_before = timezone.now() - datetime.timedelta(seconds=settings.BACKGROUND_JOB_STALE_AFTER)
+    stale = Q(heartbeat_at__lt=stale_before) | Q(heartbeat_at__isnull=True, started_at__lt=stale_before)
+    return BackgroundJob.objects.filter(stale, status=BackgroundJobStatus.RUNNING).update(
+        status=BackgroundJobStatus.QUEUED,
+        started_at=None,
+        heartbeat_at=None,
+    )
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Refreshes `heartbeat_at` of a running job from a separate thread,
+    handlers may spend long without reporting progress.
+    """
+
+    def __init__(self, job):
+        super().__init__(name=f"heartbeat-{job.id}", daemon=True)
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.BACKGROUND_JOB_HEARTBEAT_INTERVAL):
+                try:
+                    _claimed(self.job).update(heartbeat_at=timezone.now())
+                except DatabaseError as e:
+                    # E.g. SQLite locked by the job's transaction, the next beat tries again
+                    logger.warning(f"Heartbeat of background job {self.job.id} failed: {e}")
+        finally:
+            # The thread has its own connection
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _run_inspection_upload(job):
+    path = job.input_file.path
+    with open(path, 'rb') as f:
+        num_updated, error_message = add_inspection(
+            job.created_by,
+            job.company,
+            SpooledFile(f, name=os.path.basename(path)),
+            progress=lambda progress: set_job_progress(job, progress),
+        )
+
+    if error_message:
+        return {'success': False, 'error': error_message}
+    enqueue_photo_processing(job.company, job.created_by)
+    return {'success': True, 'updated_count': num_updated}
+
+
+def _run_inspection_batch_upload(job):
+    path = job.input_file.path
+    with open(path, 'rb') as f:
+        result = add_inspection_batch(
+            job.created_by,
+            job.company,
+            SpooledFile(f, name=os.path.basename(path)),
+            progress=lambda progress: set_job_progress(job, progress),
+        )
+    if result['updated_count']:
+        enqueue_photo_processing(job.company, job.created_by)
+    return result
+
+
+def _run_photo_processing(job):
+    photos = list(
+        FaultPhoto.objects.filter(fault_inspection__inspection__building__company=job.company, renditions_ready=False).only('id', 'photo')
+    )
+    processed = []
+    failed = 0
+    for i, fault_photo in enumerate(photos, start=1):
+        try:
+            make_renditions(fault_photo.photo.path)
+            processed.append(fault_photo.id)
+        except PhotoProcessingError as e:
+            logger.warning(str(e))
+            failed += 1
+        if i % 50 == 0:
+            set_job_progress(job, i * 100 // len(photos))
+
+    FaultPhoto.objects.filter(id__in=processed).update(renditions_ready=True)
+    # Photos that cannot be decoded are served as they are, they do not fail the job
+    return {'success': True, 'updated_count': len(processed), 'failed_count': failed}
+
+
+def _job_owner(job):
+    return BuildingOwner.objects.filter(pk=job.parameters.get('owner_id'), managed_by=job.company).first()
+
+
+def _run_sheet_import(job, import_data):
+    owner = _job_owner(job)
+    if owner is None:
+        return {'success': False, 'error': _("Selected owner does not exist.")}
+
+    # Rows parsed, created, updated and failed so far, each batch is committed before it is reported
+    stats = {}
+
+    def progress(percent, import_stats):
+        stats.update(import_stats)
+        set_job_progress(job, percent, result=dict(stats))
+
+    path = job.input_file.path
+    try:
+        with open(path, 'rb') as f:
+            # The name keeps the extension the sheet format is recognized by
+            num_imported, error_message = import_data(File(f, name=os.path.basename(path)), owner, job.company, progress=progress)
+    except Exception:
+        logger.exception(f"Background job {job.id} failed")
+        return {'success': False, 'error': _("Unexpected error while importing, the rows before it were imported."), **stats}
+
+    if error_message:
+        return {'success': False, 'error': error_message, **stats}
+    return {'success': True, 'updated_count': num_imported, **stats}
+
+
+def _run_sheet_preview(job, preview_data):
+    owner = _job_owner(job)
+    if owner is None:
+        return {'success': False, 'error': _("Selected owner does not exist.")}
+
+    path = job.input_file.path
+    with open(path, 'rb') as f:
+        preview, error_message = preview_data(
+            File(f, name=os.path.basename(path)), owner, job.company,
+            progress=lambda percent, import_stats: set_job_progress(job, percent, result=dict(import_stats)),
+        )
+    if error_message:
+        return {'success': False, 'error': error_message}
+
+    stats = {key: preview.pop(key) for key in ('rows', 'created', 'updated', 'failed')}
+    # Large sheets change thousands of records, the page lists the first ones of each kind
+    changes = {key: {'count': len(items), 'items': items[:IMPORT_PREVIEW_SHOWN]} for key, items in preview.items()}
+    return {'success': True, **stats, 'changes': changes}
+
+
+# The import pipeline needs pandas, imported when an import runs since web workers load this module too
+
+def _run_building_manager_import(job):
+    from .imports import import_building_manager_data
+    return _run_sheet_import(job, import_building_manager_data)
+
+
+def _run_firedistinguisher_import(job):
+    from .imports import import_firedistinguisher_data
+    return _run_sheet_import(job, import_firedistinguisher_data)
+
+
+def _run_building_manager_preview(job):
+    from .imports import preview_building_manager_data
+    return _run_sheet_preview(job, preview_building_manager_data)
+
+
+def _run_firedistinguisher_preview(job):
+    from .imports import preview_firedistinguisher_data
+    return _run_sheet_preview(job, preview_firedistinguisher_data)
+
+
+# Functions processing each kind of job, returning the result stored with the job
+JOB_HANDLERS = {
+    BackgroundJobKind.INSPECTION_UPLOAD: _run_inspection_upload,
+    BackgroundJobKind.INSPECTION_BATCH_UPLOAD: _run_inspection_batch_upload,
+    BackgroundJobKind.PHOTO_PROCESSING: _run_photo_processing,
+    BackgroundJobKind.BUILDING_MANAGER_IMPORT: _run_building_manager_import,
+    BackgroundJobKind.FIREDISTINGUISHER_IMPORT: _run_firedistinguisher_import,
+    BackgroundJobKind.BUILDING_MANAGER_PREVIEW: _run_building_manager_preview,
+    BackgroundJobKind.FIREDISTINGUISHER_PREVIEW: _run_firedistinguisher_preview,
+}
+
+
+def run_job(job):
+    """
+    Process a claimed job and store its result, unless the job was queued again meanwhile.
+    """
+    heartbeat = _Heartbeat(job)
+    heartbeat.start()
+    try:
+        result = JOB_HANDLERS[job.kind](job)
+    except Exception:
+        logger.exception(f"Background job {job.id} failed")
+        result = {'success': False, 'error': _("Unexpected error while processing the job.")}
+    finally:
+        heartbeat.stop()
+
+    input_file = job.input_file
+    job.status = BackgroundJobStatus.SUCCEEDED if result.get('success') else BackgroundJobStatus.FAILED
+    job.result = result
+    job.progress = 100
+    job.finished_at = timezone.now()
+    job.input_file = None
+    finished = _claimed(job).update(
+        status=job.status,
+        result=result,
+        progress=job.progress,
+        finished_at=job.finished_at,
+        input_file=None,
+    )
+    if not finished:
+        # The run owning the job now keeps its input and stores its own result
+        logger.warning(f"Background job {job.id} was queued again while it ran, its result is dropped")
+        return job
+
+    # The input was consumed (or moved into place) by the job
+    if input_file:
+        input_file.storage.delete(input_file.name)
+    return job
+
+
+def job_status_data(job):
+    """
+    JSON status of a job. A finished job also carries its result in the shape
+    the synchronous API returns it, e.g. `success` with `updated_count` or `error`.
+    """
+    data = {'job_id': job.id, 'status': job.status, 'progress': job.progress}
+    data.update(job.result or {})
+    return data
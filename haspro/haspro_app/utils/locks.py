@@ -0,0 +1,48 @@
+import contextlib
+import fcntl
+import os
+import time
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Exclusive lock shared by all worker processes on the machine, held while the block runs.
+    Blocks until the lock is free.
+    """
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def limited_slots(directory, name, slots, timeout=None, poll_interval=0.2):
+    """
+    Allow at most `slots` holders across all worker processes at once (a file based semaphore).
+    :param timeout: Seconds to wait for a free slot, None waits forever.
+    :raises TimeoutError: if no slot became free in time.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    while True:
+        for slot in range(slots):
+            lock_file = open(os.path.join(directory, f"{name}_{slot}.lock"), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+
+            try:
+                yield slot
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError(f"No free {name} slot within {timeout} seconds.")
+        time.sleep(poll_interval)
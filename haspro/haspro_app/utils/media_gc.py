@@ -0,0 +1,127 @@
+import os
+import re
+import sqlite3
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import models
+
+from .photos import PHOTO_RENDITIONS
+
+
+# Rows read from the database at once while marking referenced files
+MARK_CHUNK_SIZE = 5000
+
+# Renditions are named `<original without extension>.<size>.jpg`, see `rendition_path`
+RENDITION_RE = re.compile(r"^(?P<root>.+)\.(?:%s)\.jpg$" % "|".join(map(re.escape, PHOTO_RENDITIONS)))
+
+
+def media_file_fields():
+    """
+    The (model, field name) pairs of file fields whose files are stored in MEDIA_ROOT.
+    """
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    return [
+        (model, field.name)
+        for model in apps.get_models()
+        for field in model._meta.concrete_fields
+        if isinstance(field, models.FileField)
+        and isinstance(field.storage, FileSystemStorage)
+        and os.path.realpath(field.storage.location) == media_root
+    ]
+
+
+def mark_referenced_media(marked):
+    """
+    Stream the names of all files referenced from the database into the `marked` table
+    of a SQLite connection, which keeps them on disk instead of in memory.
+    :return: The number of referencing rows.
+    """
+    marked.execute("CREATE TABLE IF NOT EXISTS marked (name TEXT PRIMARY KEY) WITHOUT ROWID")
+    num_rows = 0
+    for model, field_name in media_file_fields():
+        names = (
+            model._default_manager
+            .exclude(**{field_name: ''})
+            .exclude(**{f"{field_name}__isnull": True})
+            .values_list(field_name, flat=True)
+            .iterator(chunk_size=MARK_CHUNK_SIZE)
+        )
+        batch = []
+        for name in names:
+            batch.append((name,))
+            if len(batch) >= MARK_CHUNK_SIZE:
+                marked.executemany("INSERT OR IGNORE INTO marked VALUES (?)", batch)
+                num_rows += len(batch)
+                batch = []
+        marked.executemany("INSERT OR IGNORE INTO marked VALUES (?)", batch)
+        num_rows += len(batch)
+    marked.commit()
+    return num_rows
+
+
+def _walk_files(root, skip_dirs):
+    """Relative names, sizes and modification times of the files under `root`, one directory open at a time."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.realpath(entry.path) not in skip_dirs:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    name = os.path.relpath(entry.path, root).replace(os.sep, "/")
+                    yield name, stat.st_size, stat.st_mtime
+
+
+def _is_marked(marked, name):
+    # A rendition lives as long as its original, whatever the original's extension is
+    match = RENDITION_RE.match(name)
+    if match:
+        root = match.group("root")
+        row = marked.execute("SELECT 1 FROM marked WHERE name > ? AND name < ? LIMIT 1", (root + ".", root + "/")).fetchone()
+        return row is not None
+    return marked.execute("SELECT 1 FROM marked WHERE name = ?", (name,)).fetchone() is not None
+
+
+def find_orphaned_media(marked, min_age):
+    """
+    Files in MEDIA_ROOT not referenced by any row marked in `marked`.
+    Files younger than `min_age` seconds are kept, they may belong to an import not committed yet.
+    Content stored again is touched by the storage, so a file an import reuses is young again.
+    Cache directories configured inside MEDIA_ROOT are not swept.
+    :return: Generator of (name, size).
+    """
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    if not os.path.isdir(media_root):
+        return
+    skip_dirs = {os.path.realpath(str(settings.SNAPSHOT_CACHE_DIR)), os.path.realpath(str(settings.UPLOAD_SESSION_DIR))}
+    created_before = time.time() - min_age
+
+    for name, size, mtime in _walk_files(media_root, skip_dirs):
+        if mtime < created_before and not _is_marked(marked, name):
+            yield name, size
+
+
+def delete_media_files(names):
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    num_deleted = 0
+    for name in names:
+        try:
+            os.remove(os.path.join(media_root, name))
+            num_deleted += 1
+        except FileNotFoundError:
+            pass
+    return num_deleted
+
+
+def open_mark_db(path):
+    marked = sqlite3.connect(path)
+    # A scratch database, rebuilt on every run
+    marked.execute("PRAGMA journal_mode = OFF")
+    marked.execute("PRAGMA synchronous = OFF")
+    return marked
@@ -0,0 +1,81 @@
+import os
+
+from PIL import Image, ImageOps
+
+
+# Downscaled copies of fault photos: name -> (longest side in pixels, JPEG quality)
+PHOTO_RENDITIONS = {
+    'thumb': (320, 75),
+    'web': (1600, 82),
+}
+
+
+class PhotoProcessingError(Exception):
+    pass
+
+
+def rendition_path(original_path, size):
+    """
+    Path of a rendition, stored next to the original as `<name>.<size>.jpg`.
+    """
+    root, _ = os.path.splitext(original_path)
+    return f"{root}.{size}.jpg"
+
+
+def _save_rendition(image, path, size):
+    max_side, quality = PHOTO_RENDITIONS[size]
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    # Written aside and renamed, a concurrent request never serves a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        image.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def make_renditions(original_path, sizes=None, force=False):
+    """
+    Create the missing renditions of an original photo. Works on plain paths only,
+    so it can run in worker processes of the backfill command.
+    :param sizes: Names from PHOTO_RENDITIONS, all of them by default.
+    :param force: Recreate renditions that already exist.
+    :return: The paths of the renditions by size.
+    :raises PhotoProcessingError: if the original is missing or is not an image.
+    """
+    paths = {size: rendition_path(original_path, size) for size in sizes or PHOTO_RENDITIONS}
+    missing = [size for size, path in paths.items() if force or not os.path.exists(path)]
+    if not missing:
+        return paths
+
+    try:
+        with Image.open(original_path) as image:
+            # JPEGs are decoded at a reduced scale that still covers the largest rendition
+            largest = max(PHOTO_RENDITIONS[size][0] for size in missing)
+            image.draft('RGB', (largest, largest))
+            # Phones store the orientation in EXIF, renditions are rotated instead since they drop it
+            image = ImageOps.exif_transpose(image)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            # The largest rendition first, the smaller ones are scaled down from it
+            for size in sorted(missing, key=lambda size: PHOTO_RENDITIONS[size][0], reverse=True):
+                _save_rendition(image, paths[size], size)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise PhotoProcessingError(f"Cannot process photo {original_path}: {e}") from e
+
+    return paths
+
+
+
+def make_renditions_task(original_path, force=False):
+    """
+    `make_renditions` for a process pool, a failure is returned as its message instead of raised.
+    """
+    try:
+        make_renditions(original_path, force=force)
+    except PhotoProcessingError as e:
+        return str(e)
+    return None
@@ -0,0 +1,117 @@
+import datetime
+
+from django.db.models import Max
+from django.utils import timezone
+
+from ..models import (
+    Firedistinguisher,
+    FiredistinguisherKind,
+    FiredistinguisherServiceAction,
+    FiredistinguisherServiceActionType,
+)
+
+
+NEXT_INSPECTION_INTERVAL = datetime.timedelta(days=365)
+PERIODIC_TEST_INTERVAL_WATER_FOAM = datetime.timedelta(days=365 * 3)
+PERIODIC_TEST_INTERVAL = datetime.timedelta(days=365 * 5)
+
+# Service actions that affect the schedule of an extinguisher
+SCHEDULING_ACTIONS = (
+    FiredistinguisherServiceActionType.INSPECTION,
+    FiredistinguisherServiceActionType.PERIODIC_TEST,
+    FiredistinguisherServiceActionType.ELIMINATION,
+)
+
+# Extinguishers recalculated (and updated) per batch
+RECALCULATION_CHUNK_SIZE = 1000
+
+
+def to_local_date(moment):
+    """
+    Date of a (timezone aware) datetime in the project time zone, the way a DateField stores it.
+    """
+    if isinstance(moment, datetime.datetime):
+        if timezone.is_aware(moment):
+            moment = timezone.make_naive(moment, timezone.get_default_timezone())
+        return moment.date()
+    return moment
+
+
+def _scheduled_values(fd, last_actions):
+    """
+    Schedule of one extinguisher from the time of its latest service action of each type.
+    Fields not determined by the history are kept as they are.
+    """
+    if FiredistinguisherServiceActionType.ELIMINATION in last_actions:
+        return {'eliminated': True, 'next_inspection': None, 'next_periodic_test': None}
+
+    values = {}
+    last_inspection = last_actions.get(FiredistinguisherServiceActionType.INSPECTION)
+    last_periodic_test = last_actions.get(FiredistinguisherServiceActionType.PERIODIC_TEST)
+
+    # A periodic test includes an inspection
+    last_check = max(filter(None, (last_inspection, last_periodic_test)), default=None)
+    if last_check:
+        values['next_inspection'] = to_local_date(last_check + NEXT_INSPECTION_INTERVAL)
+
+    if last_periodic_test:
+        if fd.kind in (FiredistinguisherKind.WATER, FiredistinguisherKind.FOAM):
+            values['next_periodic_test'] = to_local_date(last_periodic_test + PERIODIC_TEST_INTERVAL_WATER_FOAM)
+        else:
+            values['next_periodic_test'] = to_local_date(last_periodic_test + PERIODIC_TEST_INTERVAL)
+
+    return values
+
+
+def _apply_schedules(history):
+    now = timezone.now()
+    changed = []
+    for fd in Firedistinguisher.objects.filter(pk__in=history.keys()).only('kind', 'eliminated', 'next_inspection', 'next_periodic_test'):
+        values = _scheduled_values(fd, history[fd.pk])
+        if all(getattr(fd, field) == value for field, value in values.items()):
+            continue
+        for field, value in values.items():
+            setattr(fd, field, value)
+        fd.updated_at = now
+        changed.append(fd)
+
+    Firedistinguisher.objects.bulk_update(changed, ['eliminated', 'next_inspection', 'next_periodic_test', 'updated_at'], batch_size=RECALCULATION_CHUNK_SIZE)
+    return len(changed)
+
+
+def recalculate_firedistinguishers(firedistinguishers=None):
+    """
+    Recompute `next_inspection`, `next_periodic_test` and `eliminated` of extinguishers from
+    their service action history:
+    - an elimination marks the extinguisher eliminated and clears both dates
+    - the next inspection is due a year after the latest inspection or periodic test
+    - the next periodic test is due three (water, foam) or five years after the latest one
+    The latest actions are found with one grouped query and the changes are written
+    with bulk updates, one batch per RECALCULATION_CHUNK_SIZE extinguishers.
+    :param firedistinguishers: Queryset or list of ids to recalculate, None for the whole fleet.
+    :return: The number of updated extinguishers.
+    """
+    actions = FiredistinguisherServiceAction.objects.filter(action_type__in=SCHEDULING_ACTIONS)
+    if firedistinguishers is not None:
+        actions = actions.filter(firedistinguisher__in=firedistinguishers)
+
+    latest_actions = (
+        actions
+        .values_list('firedistinguisher', 'action_type')
+        .annotate(last_at=Max('created_at'))
+        .order_by('firedistinguisher')
+    )
+
+    num_updated = 0
+    history = {}
+    for fd_id, action_type, last_at in latest_actions.iterator(chunk_size=RECALCULATION_CHUNK_SIZE):
+        # Rows are ordered by extinguisher, so a full chunk never splits one
+        if fd_id not in history and len(history) >= RECALCULATION_CHUNK_SIZE:
+            num_updated += _apply_schedules(history)
+            history = {}
+        history.setdefault(fd_id, {})[action_type] = last_at
+
+    if history:
+        num_updated += _apply_schedules(history)
+
+    return num_updated
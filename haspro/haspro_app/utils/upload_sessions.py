@@ -0,0 +1,145 @@
+import datetime
+import glob
+import os
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from ..models import UploadSession
+from .add_inspection import SpooledFile
+from .locks import file_lock
+
+
+# Bytes copied from the request into the spool file at once
+UPLOAD_CHUNK_READ_SIZE = 64 * 1024
+
+
+class UploadSessionError(Exception):
+    pass
+
+
+class UploadOffsetMismatch(UploadSessionError):
+    """The chunk does not continue where the received data ends, `offset` is where it should."""
+    def __init__(self, offset):
+        super().__init__(_("The chunk must start at offset %(offset)d.") % {'offset': offset})
+        self.offset = offset
+
+
+def _session_path(session, suffix):
+    upload_dir = str(settings.UPLOAD_SESSION_DIR)
+    os.makedirs(upload_dir, exist_ok=True)
+    return os.path.join(upload_dir, f"session_{session.pk}{suffix}")
+
+
+def _remove_session(session):
+    # With the links of imports a crashed worker left behind
+    for path in [_session_path(session, '.part'), _session_path(session, '.lock'), *glob.glob(_session_path(session, '.*.import'))]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    session.delete()
+
+
+def _restart_lost_spool(session):
+    # A spool file lost with the data of a session, e.g. not kept on a volume over a restart,
+    # is started over, the client then resends the file from the beginning
+    path = _session_path(session, '.part')
+    if os.path.exists(path):
+        return
+    open(path, 'wb').close()
+    if session.received:
+        session.received = 0
+        session.save(update_fields=['received', 'updated_at'])
+
+
+def expire_upload_sessions():
+    """
+    Remove sessions not resumed within UPLOAD_SESSION_MAX_AGE, with their spool files.
+    """
+    idle_before = timezone.now() - datetime.timedelta(seconds=settings.UPLOAD_SESSION_MAX_AGE)
+    for session in UploadSession.objects.filter(updated_at__lt=idle_before):
+        _remove_session(session)
+
+
+def start_upload_session(company, user, file_name, size):
+    if size <= 0 or size > settings.UPLOAD_SESSION_MAX_SIZE:
+        raise UploadSessionError(_("The file size must be between 1 and %(max_size)d bytes.") % {'max_size': settings.UPLOAD_SESSION_MAX_SIZE})
+
+    expire_upload_sessions()
+
+    session = UploadSession.objects.create(
+        company=company,
+        created_by=user,
+        file_name=os.path.basename(file_name or '') or 'inspection.db',
+        size=size,
+    )
+    open(_session_path(session, '.part'), 'wb').close()
+    return session
+
+
+def write_upload_chunk(session, offset, stream, length):
+    """
+    Store `length` bytes read from `stream` at `offset` of the spool file.
+    Chunks must follow each other, the data received so far is never sent again.
+    :return: The offset the next chunk starts at.
+    :raises UploadOffsetMismatch: if the chunk does not start where the received data ends.
+    """
+    with file_lock(_session_path(session, '.lock')):
+        # Another request may have stored a chunk meanwhile
+        session.refresh_from_db(fields=['received'])
+        _restart_lost_spool(session)
+        if offset != session.received:
+            raise UploadOffsetMismatch(session.received)
+        if offset + length > session.size:
+            raise UploadSessionError(_("The chunk exceeds the declared file size."))
+
+        with open(_session_path(session, '.part'), 'r+b') as f:
+            # Drops data of a chunk that was written but not recorded
+            f.seek(offset)
+            f.truncate()
+            remaining = length
+            while remaining:
+                data = stream.read(min(UPLOAD_CHUNK_READ_SIZE, remaining))
+                if not data:
+                    break  # Client disconnected, keep what arrived
+                f.write(data)
+                remaining -= len(data)
+            received = f.tell()
+
+        session.received = received
+        session.save(update_fields=['received', 'updated_at'])
+        return received
+
+
+def open_completed_upload(session):
+    """
+    The assembled file of a completely received session, a link to the spool file the import moves into the storage.
+    Remove the session with `close_upload_session` once imported, or keep it for another attempt with `release_completed_upload`.
+    """
+    with file_lock(_session_path(session, '.lock')):
+        session.refresh_from_db(fields=['received'])
+        _restart_lost_spool(session)
+        if session.received != session.size:
+            raise UploadOffsetMismatch(session.received)
+        # The spool stays in place when a failed import already moved the link, and a finalize running at once gets its own
+        path = _session_path(session, f'.{uuid.uuid4().hex}.import')
+        os.link(_session_path(session, '.part'), path)
+        return SpooledFile(open(path, 'rb'), name=session.file_name)
+
+
+def release_completed_upload(file):
+    """Close a file of `open_completed_upload` and remove its link unless the storage took it."""
+    file.close()
+    try:
+        os.remove(file.temporary_file_path())
+    except FileNotFoundError:
+        pass
+
+
+def close_upload_session(session, file=None):
+    if file:
+        release_completed_upload(file)
+    _remove_session(session)
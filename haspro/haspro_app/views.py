@@ -1,19 +1,24 @@
 
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from urllib3 import request
-from .models import Building, BuildingOwner, BuildingManager, Firedistinguisher, FiredistinguisherPlacement, Company, Fault, PossibleFault
+from .models import Building, BuildingOwner, BuildingManager, Firedistinguisher, FiredistinguisherPlacement, Company, Fault, FaultPhoto, PossibleFault, BackgroundJob, BackgroundJobKind, BackgroundJobStatus, UploadSession
 from .forms.building_form import BuildingForm
 from .forms.owner_form import BuildingOwnerForm
 from .forms.buildingmanager_form import BuildingManagerForm
 from .forms.fireestinguisher_form import FiredistinguisherForm
 from .forms.feplacement_form import FiredistinguisherPlacementForm
-from .utils.db_dump import create_snapshot_file
-from .utils.imports import import_building_manager_data, import_firedistinguisher_data
-from .utils.add_inspection import add_inspection
+from .utils.db_dump import choose_snapshot_encoding, create_snapshot_file, get_company_data_version, parse_sync_cursor, select_route_buildings
+from .utils.add_inspection import add_inspection, add_inspection_batch, find_imported_upload, get_upload_sha256
+from .utils.photos import PHOTO_RENDITIONS, PhotoProcessingError, make_renditions
+from .utils.jobs import IMPORT_JOB_KINDS, IMPORT_PREVIEW_JOB_KINDS, enqueue_job, enqueue_photo_processing, job_status_data
+from .utils.upload_sessions import UploadOffsetMismatch, UploadSessionError, close_upload_session, open_completed_upload, release_completed_upload, start_upload_session, write_upload_chunk
 from django.http import FileResponse, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, quote_etag
 from django.contrib import messages
 from django.utils.translation import gettext as _
 import logging
+import os
 import traceback
 from django.db.models import Max
 from users.utils import project_permission_decorator
@@ -22,6 +27,12 @@ from django.middleware.csrf import get_token
 
 logger = logging.getLogger(__name__)
 
+# Seconds browsers may reuse a served fault photo
+PHOTO_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# Most recent imports listed on the tools page
+IMPORT_JOBS_SHOWN = 5
+
 def company_decorator(view_func):
     def _wrapped_view(request, *args, **kwargs):
         company = Company.objects.filter(project=request.project).first()
@@ -288,7 +299,72 @@ def firedistinguisher_delete(request, pk):
 @project_permission_decorator(require_admin=True)
 @company_decorator
 def tools_view(request):
-    return render(request, 'tools/tools.html', {'owners': BuildingOwner.objects.filter(managed_by=request.company).all()})
+    return render(request, 'tools/tools.html', {
+        'owners': BuildingOwner.objects.filter(managed_by=request.company).all(),
+        **_import_jobs_context(request),
+    })
+
+
+def _import_jobs_context(request):
+    import_jobs = list(BackgroundJob.objects.filter(company=request.company, kind__in=IMPORT_JOB_KINDS).order_by('-created_at', '-id')[:IMPORT_JOBS_SHOWN])
+    for job in import_jobs:
+        # A finished preview links to the changes it found
+        job.is_preview = job.kind in IMPORT_PREVIEW_JOB_KINDS
+    return {
+        'import_jobs': import_jobs,
+        # The list refreshes itself until every shown import finished
+        'import_jobs_pending': any(job.status in (BackgroundJobStatus.QUEUED, BackgroundJobStatus.RUNNING) for job in import_jobs),
+    }
+
+
+@project_permission_decorator(require_admin=True)
+@company_decorator
+def import_jobs(request):
+    # Fragment of the tools page polled by htmx
+    return render(request, 'tools/import_jobs.html', _import_jobs_context(request))
+
+
+@project_permission_decorator(require_admin=True)
+@company_decorator
+def import_preview(request, pk):
+    # Changes found by a finished preview job, the sheet is read by the `run_jobs` worker
+    job = BackgroundJob.objects.filter(
+        pk=pk, company=request.company, kind__in=IMPORT_PREVIEW_JOB_KINDS, status=BackgroundJobStatus.SUCCEEDED,
+    ).first()
+    if not job:
+        messages.error(request, _("Import preview not found."))
+        return redirect('haspro_app:tools-view')
+
+    changes = job.result['changes']
+    if job.kind == BackgroundJobKind.BUILDING_MANAGER_PREVIEW:
+        title = _("Building manager import preview")
+        sections = [
+            (_("New buildings"), changes['new_buildings']),
+            (_("Changed buildings"), changes['changed_buildings']),
+            (_("New managers"), changes['new_managers']),
+            (_("Changed managers"), changes['changed_managers']),
+            (_("Rows without a building ID"), changes['invalid_rows']),
+        ]
+    else:
+        title = _("Fire extinguisher import preview")
+        moved = changes['moved_firedistinguishers']
+        sections = [
+            (_("New fire extinguishers"), changes['new_firedistinguishers']),
+            (_("Changed fire extinguishers"), changes['changed_firedistinguishers']),
+            (_("Moved fire extinguishers"), {**moved, 'items': [f"{serial_number} → {building_id}" for serial_number, building_id in moved['items']]}),
+            (_("Fire extinguishers in buildings not found"), changes['unplaced_firedistinguishers']),
+            (_("Rows without a serial number"), changes['invalid_rows']),
+        ]
+
+    return render(request, 'tools/import_preview.html', {
+        'title': title,
+        'owner': BuildingOwner.objects.filter(pk=job.parameters.get('owner_id')).first(),
+        'preview': job.result,
+        'sections': [
+            {'label': label, 'count': section['count'], 'items': section['items'], 'more': section['count'] - len(section['items'])}
+            for label, section in sections
+        ],
+    })
 
 
 @project_permission_decorator(require_admin=True)
@@ -307,11 +383,15 @@ def import_building_manager_list(request):
                 messages.error(request, _("Error importing building manager data: No owner selected."))
                 return redirect('haspro_app:tools-view')
 
-            num_imported, error_message = import_building_manager_data(file, owner, request.company)
-            if error_message:
-                messages.error(request, _("Error importing building manager data: %(error)s") % {'error': error_message})
-            else:
-                messages.success(request, _("Successfully imported %(count)d buildings and their managers.") % {'count': num_imported})
+            if request.POST.get('preview') == 'true':
+                # Read by the `run_jobs` worker like an import, the tools page links to the changes once found
+                enqueue_job(BackgroundJobKind.BUILDING_MANAGER_PREVIEW, request.company, request.user, input_file=file, parameters={'owner_id': owner.id})
+                messages.success(request, _("Building manager data were queued for preview."))
+                return redirect('haspro_app:tools-view')
+
+            # Imported by the `run_jobs` worker, the tools page shows the progress
+            enqueue_job(BackgroundJobKind.BUILDING_MANAGER_IMPORT, request.company, request.user, input_file=file, parameters={'owner_id': owner.id})
+            messages.success(request, _("Building manager data were queued for import."))
 
         else:
             messages.error(request, _("Error importing building manager data: No file provided."))
@@ -334,11 +414,15 @@ def import_firedistinguisher_list(request):
                 messages.error(request, _("Error importing fire extinguisher data: No owner selected."))
                 return redirect('haspro_app:tools-view')
 
-            num_imported, error_message = import_firedistinguisher_data(file, owner, request.company)
-            if error_message:
-                messages.error(request, _("Error importing fire extinguisher data: %(error)s") % {'error': error_message})
-            else:
-                messages.success(request, _("Successfully imported %(count)d fire extinguisher records.") % {'count': num_imported})
+            if request.POST.get('preview') == 'true':
+                # Read by the `run_jobs` worker like an import, the tools page links to the changes once found
+                enqueue_job(BackgroundJobKind.FIREDISTINGUISHER_PREVIEW, request.company, request.user, input_file=file, parameters={'owner_id': owner.id})
+                messages.success(request, _("Fire extinguisher data were queued for preview."))
+                return redirect('haspro_app:tools-view')
+
+            # Imported by the `run_jobs` worker, the tools page shows the progress
+            enqueue_job(BackgroundJobKind.FIREDISTINGUISHER_IMPORT, request.company, request.user, input_file=file, parameters={'owner_id': owner.id})
+            messages.success(request, _("Fire extinguisher data were queued for import."))
 
         else:
             messages.error(request, _("Error importing fire extinguisher data: No file provided."))
@@ -362,11 +446,67 @@ def export_reports_for_owner(request, owner_id):
 
 
 
+# _______________________________ Fault photos _______________________________
+
+@project_permission_decorator(require_view=True)
+@company_decorator
+def fault_photo(request, pk, size):
+    """
+    Serve a fault photo in one of the PHOTO_RENDITIONS sizes, or the `original`.
+    Renditions missing since the photo processing job has not run yet are made on this request.
+    """
+    photo = FaultPhoto.objects.filter(pk=pk, fault_inspection__inspection__building__company=getattr(request, 'company', None)).first()
+    if not photo or (size != 'original' and size not in PHOTO_RENDITIONS):
+        return render(request, '404.html', {'error_message': _("Photo not found.")}, status=404)
+
+    path = photo.photo.path
+    if size != 'original':
+        try:
+            path = make_renditions(path, sizes=[size])[size]
+        except PhotoProcessingError as e:
+            # Not decodable by Pillow, the browser may still display it
+            logger.warning(str(e))
+    if not os.path.exists(path):
+        return render(request, '404.html', {'error_message': _("Photo not found.")}, status=404)
+
+    response = FileResponse(open(path, 'rb'))
+    # A photo never changes, only its renditions may be recreated with the same content
+    patch_cache_control(response, private=True, max_age=PHOTO_CACHE_MAX_AGE)
+    return response
+
+
 # _______________________________ Mobile app interface _______________________________
 
 @project_permission_decorator(require_view=True)
 @company_decorator
 def get_db_snapshot(request):    
+    # Clients send the cursor of their last sync to receive only the changes since then
+    since = None
+    if request.GET.get('since'):
+        try:
+            since = parse_sync_cursor(request.GET['since'])
+        except ValueError:
+            return JsonResponse({'success': False, 'error': _("Invalid sync cursor.")}, status=400)
+
+    # A technician's route can be limited to ?buildings=1,2,3 and/or to buildings due for inspection within ?due_within=N days
+    building_ids = None
+    due_within_days = None
+    try:
+        if request.GET.get('buildings'):
+            building_ids = [int(building_id) for building_id in request.GET['buildings'].split(',') if building_id.strip()]
+        if request.GET.get('due_within'):
+            due_within_days = int(request.GET['due_within'])
+            if due_within_days < 0:
+                raise ValueError("due_within must not be negative")
+    except ValueError:
+        return JsonResponse({'success': False, 'error': _("Invalid building selection.")}, status=400)
+    is_partial = building_ids is not None or due_within_days is not None
+
+    # Compression is negotiated through Accept-Encoding or forced with ?compression=gzip|none
+    try:
+        encoding = choose_snapshot_encoding(request.headers.get('Accept-Encoding'), request.GET.get('compression'))
+    except ValueError:
+        return JsonResponse({'success': False, 'error': _("Unsupported compression.")}, status=400)
 
     # Logic to create a snapshot
     try:
@@ -374,14 +514,102 @@ def get_db_snapshot(request):
             return render(request, '404.html', {
                 'error_message': _("No company found for the current project.")
             }, status=404)
-        buffer = create_snapshot_file(request.company)
+
+        # Full snapshots are versioned, so clients already holding the current one get a 304
+        version = None
+        etag = None
+        buildings = None
+        if is_partial:
+            buildings = select_route_buildings(request.company, building_ids=building_ids, due_within_days=due_within_days)
+        elif since is None:
+            version = get_company_data_version(request.company)
+            etag = quote_etag(f"{version}-{encoding}" if encoding else version)
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                # Caches and clients keep the validator they revalidated
+                return _patch_snapshot_caching(not_modified, etag)
+
+        snapshot, cursor, snapshot_version = create_snapshot_file(request.company, since=since, version=version, encoding=encoding, buildings=buildings)
+        if snapshot_version != version:
+            # The data changed meanwhile, a newer version was served
+            etag = quote_etag(f"{snapshot_version}-{encoding}" if encoding else snapshot_version)
+    except TimeoutError:
+        # All build slots are busy, the app retries later
+        response = JsonResponse({'success': False, 'error': _("Server is busy building snapshots, try again later.")}, status=503)
+        response['Retry-After'] = '30'
+        return response
     except Exception as e:
         logger.error(f"Error creating snapshot for user {request.user.id}: {e} Traceback: {traceback.format_exc()}", exc_info=True)
         return render(request, '500.html', {
             'error_message': _("Error creating database snapshot.")
         }, status=500)
 
-    return FileResponse(buffer, as_attachment=True, filename='db_snapshot.bin')
+    # FileResponse streams the file in blocks (or via sendfile) and sets Content-Length
+    response = FileResponse(snapshot, as_attachment=True, filename='db_delta.bin' if since else 'db_snapshot.bin')
+    response['X-Sync-Cursor'] = cursor
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return _patch_snapshot_caching(response, etag)
+
+
+def _patch_snapshot_caching(response, etag=None):
+    if etag:
+        response['ETag'] = etag
+    patch_vary_headers(response, ('Accept-Encoding',))
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _process_inspection_upload(request, file, is_api):
+    """
+    Import an uploaded inspection database, or queue it when the request asks for `async`.
+    With `batch` the upload may hold many inspection records, or be a zip of several databases.
+    """
+    batch = request.POST.get('batch', 'false') == 'true'
+
+    # Import later in the `run_jobs` worker, the client polls the job status.
+    # A retry of an already imported file is answered right away instead.
+    if request.POST.get('async', 'false') == 'true' and (batch or not find_imported_upload(get_upload_sha256(file))):
+        kind = BackgroundJobKind.INSPECTION_BATCH_UPLOAD if batch else BackgroundJobKind.INSPECTION_UPLOAD
+        job = enqueue_job(kind, request.company, request.user, input_file=file)
+        if is_api:
+            return JsonResponse({
+                'success': True,
+                'job_id': job.id,
+                'status_url': reverse('haspro_app:job-status', args=[job.id]),
+            }, status=202)
+        messages.success(request, _("Inspection records were queued for import."))
+        return redirect('haspro_app:tools-view')
+
+    if batch:
+        result = add_inspection_batch(request.user, request.company, file)
+        if result['updated_count']:
+            enqueue_photo_processing(request.company, request.user)
+        if is_api:
+            # Partly imported batches report the failed records in `results`
+            return JsonResponse(result, status=200 if result['success'] or result['updated_count'] else 400)
+        if result['updated_count']:
+            messages.success(request, _("Successfully updated %(count)d inspection records.") % {'count': result['updated_count']})
+        errors = [result['error']] if 'error' in result else [r['error'] for r in result['results'] if not r['success']]
+        for error in errors:
+            messages.error(request, _("Error updating inspection records: %(error)s") % {'error': error})
+        return redirect('haspro_app:tools-view')
+
+    num_updated, error_message = add_inspection(request.user, request.company, file)
+    if error_message:
+        if is_api:
+            return JsonResponse({'success': False, 'error': error_message}, status=400)
+        else:
+            messages.error(request, _("Error updating inspection records: %(error)s") % {'error': error_message})
+    else:
+        # Thumbnails are made in the background, pages fall back to making them on first request
+        enqueue_photo_processing(request.company, request.user)
+        if is_api:
+            return JsonResponse({'success': True, 'updated_count': num_updated})
+        else:
+            messages.success(request, _("Successfully updated %(count)d inspection records.") % {'count': num_updated})
+
+    return redirect('haspro_app:tools-view')
 
 
 @project_permission_decorator(require_edit=True)
@@ -399,17 +627,7 @@ def upload_inspection_records(request):
                     messages.error(request, _("Error updating inspection records: No company found."))
                     return redirect('haspro_app:tools-view')
 
-            num_updated, error_message = add_inspection(request.user, request.company, file)
-            if error_message:
-                if is_api:
-                    return JsonResponse({'success': False, 'error': error_message}, status=400)
-                else:
-                    messages.error(request, _("Error updating inspection records: %(error)s") % {'error': error_message})
-            else:
-                if is_api:
-                    return JsonResponse({'success': True, 'updated_count': num_updated})
-                else:
-                    messages.success(request, _("Successfully updated %(count)d inspection records.") % {'count': num_updated})
+            return _process_inspection_upload(request, file, is_api)
         else:
             if is_api:
                 return JsonResponse({'success': False, 'error': _("No file provided.")}, status=400)
@@ -419,6 +637,106 @@ def upload_inspection_records(request):
     return redirect('haspro_app:tools-view')
 
 
+# _______________________________ Resumable inspection upload _______________________________
+
+def _upload_session_data(session):
+    return {
+        'success': True,
+        'session_id': session.id,
+        'offset': session.received,
+        'size': session.size,
+        'upload_url': reverse('haspro_app:upload-session', args=[session.id]),
+    }
+
+
+@project_permission_decorator(require_edit=True)
+@company_decorator
+def upload_session_start(request):
+    # Start a chunked upload, POST with `file_name` and the total `size` in bytes
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': _("Method not allowed.")}, status=405)
+    if not getattr(request, 'company', None):
+        return JsonResponse({'success': False, 'error': _("No company found.")}, status=400)
+
+    try:
+        size = int(request.POST.get('size', ''))
+        session = start_upload_session(request.company, request.user, request.POST.get('file_name'), size)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': _("Invalid file size.")}, status=400)
+    except UploadSessionError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    return JsonResponse(_upload_session_data(session), status=201)
+
+
+@project_permission_decorator(require_edit=True)
+@company_decorator
+def upload_session(request, pk):
+    # GET reports the received offset to resume from, PUT ?offset=<n> appends the request body
+    session = UploadSession.objects.filter(pk=pk, company=getattr(request, 'company', None)).first()
+    if not session:
+        return JsonResponse({'success': False, 'error': _("Upload session not found.")}, status=404)
+
+    if request.method == 'GET':
+        return JsonResponse(_upload_session_data(session))
+    if request.method != 'PUT':
+        return JsonResponse({'success': False, 'error': _("Method not allowed.")}, status=405)
+
+    try:
+        offset = int(request.GET.get('offset', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': _("Invalid chunk offset.")}, status=400)
+    if length < 0:
+        return JsonResponse({'success': False, 'error': _("Invalid chunk length.")}, status=400)
+
+    try:
+        write_upload_chunk(session, offset, request, length)
+    except UploadOffsetMismatch as e:
+        return JsonResponse({'success': False, 'error': str(e), 'offset': e.offset}, status=409)
+    except UploadSessionError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    return JsonResponse(_upload_session_data(session))
+
+
+@project_permission_decorator(require_edit=True)
+@company_decorator
+def upload_session_finalize(request, pk):
+    # Import the assembled file, answers like `upload_inspection_records` with `is_api`
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': _("Method not allowed.")}, status=405)
+    session = UploadSession.objects.filter(pk=pk, company=getattr(request, 'company', None)).first()
+    if not session:
+        return JsonResponse({'success': False, 'error': _("Upload session not found.")}, status=404)
+
+    try:
+        file = open_completed_upload(session)
+    except UploadOffsetMismatch as e:
+        return JsonResponse({'success': False, 'error': _("The upload is not complete."), 'offset': e.offset}, status=409)
+
+    try:
+        response = _process_inspection_upload(request, file, is_api=True)
+    except Exception:
+        release_completed_upload(file)
+        raise
+    if response.status_code < 400:
+        close_upload_session(session, file)
+    else:
+        # Finalize may be retried without uploading the file again, sessions not resumed expire
+        release_completed_upload(file)
+    return response
+
+
+@project_permission_decorator(require_view=True)
+@company_decorator
+def job_status(request, pk):
+    job = BackgroundJob.objects.filter(pk=pk, company=getattr(request, 'company', None)).first()
+    if not job:
+        return JsonResponse({'success': False, 'error': _("Job not found.")}, status=404)
+    return JsonResponse(job_status_data(job))
+
+
 @project_permission_decorator(require_edit=True)
 @company_decorator
 def get_csrf_token(request):
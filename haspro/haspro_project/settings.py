@@ -18,6 +18,29 @@ STATIC_DIR = BASE_DIR / 'haspro_app' / 'static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.environ.get('MEDIA_ROOT', './media/')
 
+# Default upload handlers, also computing the SHA-256 of each file as it is received
+FILE_UPLOAD_HANDLERS = [
+    'haspro_app.upload_handlers.Sha256MemoryFileUploadHandler',
+    'haspro_app.upload_handlers.Sha256TemporaryFileUploadHandler',
+]
+
+# Built mobile app snapshots, cached per company and data version
+SNAPSHOT_CACHE_DIR = os.environ.get('SNAPSHOT_CACHE_DIR', BASE_DIR / 'cache' / 'snapshots')
+# Snapshot exports allowed to run at once across all workers, and how long a request waits for a free slot
+SNAPSHOT_MAX_CONCURRENT_BUILDS = int(os.environ.get('SNAPSHOT_MAX_CONCURRENT_BUILDS', 2))
+SNAPSHOT_BUILD_WAIT_TIMEOUT = int(os.environ.get('SNAPSHOT_BUILD_WAIT_TIMEOUT', 60))
+# Seconds the sync cursor handed to the app lags behind the export, longer than any transaction writing synced rows
+SYNC_CURSOR_OVERLAP = int(os.environ.get('SYNC_CURSOR_OVERLAP', 600))
+# Spool files of resumable inspection uploads (on a persistent volume, the sessions outlive restarts),
+# the largest accepted file and how long (seconds) an idle upload can be resumed
+UPLOAD_SESSION_DIR = os.environ.get('UPLOAD_SESSION_DIR', BASE_DIR / 'cache' / 'uploads')
+UPLOAD_SESSION_MAX_SIZE = int(os.environ.get('UPLOAD_SESSION_MAX_SIZE', 500 * 1024 * 1024))
+UPLOAD_SESSION_MAX_AGE = int(os.environ.get('UPLOAD_SESSION_MAX_AGE', 2 * 24 * 3600))
+# Seconds without a heartbeat after which a background job still marked as running is considered abandoned by a crashed worker and queued again,
+# and how often (seconds) a worker sends the heartbeat of the job it runs
+BACKGROUND_JOB_STALE_AFTER = int(os.environ.get('BACKGROUND_JOB_STALE_AFTER', 3600))
+BACKGROUND_JOB_HEARTBEAT_INTERVAL = int(os.environ.get('BACKGROUND_JOB_HEARTBEAT_INTERVAL', 60))
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
 
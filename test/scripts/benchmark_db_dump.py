@@ -0,0 +1,155 @@
+"""
+Benchmark of the mobile app snapshot export.
+
+Fills a throwaway database with a synthetic company and measures the export time
+and the peak Python memory of the row-by-row exporter the snapshot used to be
+built with against the current set-based `export_project_to_sqlite`.
+
+Usage: python test/scripts/benchmark_db_dump.py [--buildings 10000] [--firedistinguishers 50000]
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'haspro'))
+
+WORK_DIR = tempfile.mkdtemp(prefix='haspro_bench_')
+os.environ['DATABASE_NAME'] = os.path.join(WORK_DIR, 'db.sqlite3')
+os.environ['DEBUG'] = 'False'
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'haspro_project.settings')
+
+import django
+from django.conf import settings
+
+django.setup()
+# Migrations are generated at build time, create the tables straight from the models
+settings.MIGRATION_MODULES = {'haspro_app': None, 'users': None}
+
+from django.core.management import call_command
+
+from users.models import User, Project
+from haspro_app.models import (
+    Company,
+    BuildingOwner,
+    BuildingManager,
+    Building,
+    Fault,
+    PossibleFault,
+    Firedistinguisher,
+    FiredistinguisherPlacement,
+    FiredistinguisherServiceAction,
+)
+from haspro_app.utils.db_dump import _company_querysets, _create_tables, export_project_to_sqlite
+
+
+def legacy_export(company, file_name):
+    """The exporter before the set-based rewrite: model instances and one INSERT per row."""
+    querysets = _company_querysets(company)
+    conn = sqlite3.connect(file_name)
+    c = conn.cursor()
+    _create_tables(c)
+
+    for obj in querysets["company"]:
+        c.execute('INSERT INTO company VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+            obj.id, obj.name, obj.address, obj.city, obj.zipcode, obj.ico, obj.dic, str(obj.logo)])
+    for obj in querysets["building_owner"]:
+        c.execute('INSERT INTO building_owner VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+            obj.id, obj.name, obj.address, obj.city, obj.zipcode, obj.ico, obj.dic, obj.managed_by_id])
+    for obj in querysets["building_manager"]:
+        c.execute('INSERT INTO building_manager VALUES (?, ?, ?, ?, ?, ?)', [
+            obj.id, obj.name, obj.address, obj.phone, obj.phone2, obj.email])
+    for obj in querysets["building"]:
+        c.execute('INSERT INTO building VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            obj.id, obj.building_id, obj.address, obj.city, obj.zipcode, obj.note, obj.company_id, obj.owner_id, obj.manager_id, obj.last_inspection_date, obj.inspection_interval_days])
+    for obj in querysets["fault"]:
+        c.execute('INSERT INTO fault VALUES (?, ?, ?, ?)', [
+            obj.id, obj.short_name, obj.description, obj.default_fix_time_days])
+    for obj in querysets["possible_fault"]:
+        c.execute('INSERT INTO possible_fault VALUES (?, ?, ?)', [
+            obj.id, obj.fault_id, obj.building_id])
+    for obj in querysets["firedistinguisher"]:
+        c.execute('INSERT INTO firedistinguisher VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            obj.id, obj.kind, obj.size, obj.power, obj.manufacturer, obj.serial_number, int(obj.eliminated), obj.manufactured_year, obj.managed_by_id, obj.next_inspection, obj.next_periodic_test])
+    for obj in querysets["firedistinguisher_placement"]:
+        c.execute('INSERT INTO firedistinguisher_placement VALUES (?, ?, ?, ?, ?)', [
+            obj.id, obj.description, str(obj.created_at), obj.firedistinguisher_id, obj.building_id])
+    for obj in querysets["firedistinguisher_service_action"]:
+        c.execute('INSERT INTO firedistinguisher_service_action VALUES (?, ?, ?, ?, ?)', [
+            obj.id, obj.action_type, obj.description, str(obj.created_at), obj.firedistinguisher_id])
+
+    conn.commit()
+    c.execute('VACUUM')
+    conn.close()
+
+
+def populate(num_buildings, num_firedistinguishers):
+    user = User.objects.create(username='benchmark')
+    project = Project.objects.create(name='Benchmark', owner=user)
+    company = Company.objects.create(project=project, name='Benchmark s.r.o.', address='Hlavní 1', city='Praha', zipcode='110 00', ico='12345678', dic='CZ12345678')
+    owner = BuildingOwner.objects.create(name='SBD Benchmark', address='Hlavní 2', city='Praha', zipcode='110 00', ico='87654321', dic='CZ87654321', managed_by=company)
+    managers = BuildingManager.objects.bulk_create(
+        BuildingManager(name=f'Správce {i}', address=f'Dlouhá {i}, 110 00 Praha', phone='+420 600 000 000', email=f'spravce{i}@example.com')
+        for i in range(num_buildings // 10 or 1)
+    )
+    faults = Fault.objects.bulk_create(
+        Fault(short_name=f'Závada {i}', description='Neprůchodná úniková cesta ' * 4, default_fix_time_days=30)
+        for i in range(20)
+    )
+    buildings = Building.objects.bulk_create(
+        Building(building_id=str(1000 + i), address=f'Dlouhá {i}', city='Praha', zipcode='110 00', note='Imported from file',
+                 company=company, owner=owner, manager=managers[i % len(managers)])
+        for i in range(num_buildings)
+    )
+    PossibleFault.objects.bulk_create(
+        PossibleFault(fault=faults[(i * 3 + j) % len(faults)], building=building)
+        for i, building in enumerate(buildings) for j in range(3)
+    )
+    firedistinguishers = Firedistinguisher.objects.bulk_create(
+        Firedistinguisher(kind='Powder', size=6, power='21A 113B C', manufacturer='Hasík', serial_number=f'{i}/19',
+                          manufactured_year=2019, managed_by=company)
+        for i in range(num_firedistinguishers)
+    )
+    FiredistinguisherPlacement.objects.bulk_create(
+        FiredistinguisherPlacement(description='Chodba 1. NP u výtahu', firedistinguisher=fd, building=buildings[i % len(buildings)])
+        for i, fd in enumerate(firedistinguishers)
+    )
+    FiredistinguisherServiceAction.objects.bulk_create(
+        FiredistinguisherServiceAction(firedistinguisher=fd, action_type='inspection', description='Kontrola provedena')
+        for fd in firedistinguishers for _ in range(2)
+    )
+    return company
+
+
+def measure(label, export, company):
+    file_name = os.path.join(WORK_DIR, f'{label}.sqlite3')
+    tracemalloc.start()
+    start = time.perf_counter()
+    export(company, file_name)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size = os.path.getsize(file_name)
+    print(f"{label:<12} {elapsed:8.2f} s {peak / 1024 / 1024:10.1f} MiB peak {size / 1024 / 1024:8.1f} MiB file")
+    os.remove(file_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--buildings', type=int, default=10000)
+    parser.add_argument('--firedistinguishers', type=int, default=50000)
+    args = parser.parse_args()
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    company = populate(args.buildings, args.firedistinguishers)
+    print(f"Exporting {args.buildings} buildings and {args.firedistinguishers} fire extinguishers")
+
+    try:
+        measure('before', legacy_export, company)
+        measure('after', export_project_to_sqlite, company)
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
@@ -0,0 +1,97 @@
+"""
+Benchmark of a web worker's cold start.
+
+Starts fresh interpreters that import `haspro_project.asgi`, the application uvicorn serves in
+production, and load the URLconf like a worker does on its first request. Reports the time and
+the peak resident memory after each step.
+The last step imports the spreadsheet import pipeline, which workers used to load at startup
+and now load only when an import runs.
+
+Usage: python test/scripts/benchmark_startup.py [--runs 5] [--max-seconds 1.5] [--max-rss 120]
+Exits with status 1 if a module kept out of the startup is imported or a limit is exceeded.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+HASPRO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'haspro')
+
+# Loaded by the import pipeline only
+LAZY_MODULES = ('pandas', 'numpy', 'openpyxl')
+
+
+def peak_rss_mib():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def run_child():
+    """Measure the startup steps in this interpreter and print them as JSON."""
+    start = time.perf_counter()
+    steps = []
+
+    import haspro_project.asgi  # noqa: F401
+    steps.append(('asgi', time.perf_counter() - start, peak_rss_mib()))
+
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+    steps.append(('urls', time.perf_counter() - start, peak_rss_mib()))
+    loaded = [name for name in LAZY_MODULES if name in sys.modules]
+
+    import haspro_app.utils.imports  # noqa: F401
+    steps.append(('imports', time.perf_counter() - start, peak_rss_mib()))
+
+    print(json.dumps({'steps': steps, 'loaded': loaded}))
+
+
+def run_once():
+    env = dict(os.environ, DEBUG='False')
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'haspro_project.settings')
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child'],
+        cwd=HASPRO_DIR, env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None, help="Limit of the median time until the URLconf is loaded.")
+    parser.add_argument('--max-rss', type=float, default=None, help="Limit of the median peak RSS in MiB until the URLconf is loaded.")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, os.getcwd())
+        run_child()
+        sys.exit(0)
+
+    runs = [run_once() for _ in range(args.runs)]
+    print(f"Median of {args.runs} cold starts")
+    medians = {}
+    for i, (step, _, _) in enumerate(runs[0]['steps']):
+        seconds = statistics.median(run['steps'][i][1] for run in runs)
+        rss = statistics.median(run['steps'][i][2] for run in runs)
+        medians[step] = (seconds, rss)
+        print(f"{step:<8} {seconds:8.3f} s {rss:8.1f} MiB peak RSS")
+
+    failed = False
+    loaded = sorted({name for run in runs for name in run['loaded']})
+    if loaded:
+        print(f"Loaded at startup: {', '.join(loaded)}")
+        failed = True
+    seconds, rss = medians['urls']
+    if args.max_seconds is not None and seconds > args.max_seconds:
+        print(f"Startup takes {seconds:.3f} s, more than {args.max_seconds} s")
+        failed = True
+    if args.max_rss is not None and rss > args.max_rss:
+        print(f"Startup needs {rss:.1f} MiB, more than {args.max_rss} MiB")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -1,23 +1,67 @@
+import gzip
+import sqlite3
+import sys
+
 from login import login
 from requests import Session
 
 
-def get_db_dump(output_file, session=None):
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def decompress(content, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(content)
+    return content
+
+
+def verify_snapshot(file_name):
+    with open(file_name, "rb") as f:
+        header = f.read(len(SQLITE_HEADER))
+    if header != SQLITE_HEADER:
+        raise Exception("Downloaded snapshot is not a SQLite database")
+
+    conn = sqlite3.connect(file_name)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    cursor = conn.execute("SELECT cursor FROM sync_info").fetchone()[0]
+    conn.close()
+
+    missing = {"company", "building", "firedistinguisher", "sync_info"} - tables
+    if missing:
+        raise Exception(f"Snapshot is missing tables: {', '.join(missing)}")
+    return cursor
+
+
+def get_db_dump(output_file, session=None, compression=None):
+    """
+    Download the snapshot, optionally compressed ('gzip' or 'none'),
+    store it uncompressed in `output_file` and verify it.
+    """
     if not session:
         session = Session()
 
     login(session)
 
-    # Fetch the database dump
-    response = session.get("http://localhost:8000/db/dump/snapshot/")
+    params = {"compression": compression} if compression else {}
+
+    # Fetch the database dump, keeping the transferred bytes as they are
+    response = session.get("http://localhost:8000/db/dump/snapshot/", params=params, stream=True)
     response.raise_for_status()
 
+    encoding = response.headers.get("Content-Encoding")
+    raw = response.raw.read(decode_content=False)
+    content = decompress(raw, encoding)
+
     # Save the dump to the specified output file
     with open(output_file, "wb") as f:
-        f.write(response.content)
+        f.write(content)
+
+    cursor = verify_snapshot(output_file)
+    if cursor != response.headers.get("X-Sync-Cursor"):
+        raise Exception("Sync cursor in the snapshot does not match the response header")
 
-    print("Database dump saved to:", output_file)
+    print(f"Database dump saved to: {output_file} ({encoding or 'uncompressed'}, {len(raw)} bytes transferred, {len(content)} bytes)")
 
 
 if __name__ == "__main__":
-    get_db_dump("./test/data/dump_test.ih")
\ No newline at end of file
+    get_db_dump("./test/data/dump_test.ih", compression=sys.argv[1] if len(sys.argv) > 1 else None)